@@ -8,5 +8,5 @@ setup(
     description='Pure-Python Tainted String',
     author='Rahul Gopinath',
     author_email='rahul@gopinath.org',
-    modules=['taintedstr'],
+    modules=['taintedstr', 'taintedbatch', 'taintedre', 'taintedio', 'taintedprof'],
     )
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the tstr hot paths, each measured against the same
+operation on a plain str so that the taint overhead shows as a factor.
+
+    python3 taintbench.py [--quick] [--json out.json] [--baseline old.json]
+
+Comparison recording is timed with a NullSink so that the log does not
+grow while timing; how fast the log grows is measured separately, with
+the default sink that appends to taintedstr.Comparisons.
+
+A run fails (exit status 1) when an operation is slower than MAX_OVERHEAD
+times str, or, given a baseline, when it is more than TOLERANCE times
+slower than the baseline run was.
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import timeit
+import tracemalloc
+
+import taintedstr
+from taintedstr import tstr, NullSink, recording
+
+SIZES = (16, 1024, 65536)
+QUICK_SIZES = (16, 1024)
+REPEAT = 3
+
+# the largest tstr/str time factor accepted for each benchmark: the
+# largest factor over all sizes in three full runs on CPython 3 (x86_64),
+# with 1.5x headroom for noise between runs
+MAX_OVERHEAD = {
+    'construct': 80,        # measured 52
+    'slice': 40,            # 24
+    'eq': 50,               # 32
+    'eq_late': 4300,        # 2862, at 64k; the scan is per character
+    'split': 320,           # 210
+    'rsplit': 200,          # 128
+    'replace': 200,         # 128
+    'join': 1100,           # 735
+    'add_chain': 300,       # 200
+    'iterate': 400,         # 271
+}
+# accepted slowdown against a baseline run
+TOLERANCE = 1.3
+
+_WORDS = ['ab', 'abc', 'key', 'value', 'x', 'lorem', 'ipsum', 'dolor']
+
+def text(n, seed=0):
+    """
+    A reproducible text of n characters of space separated words.
+    >>> text(20)
+    'ipsum ipsum ab x dol'
+    >>> text(20) == text(20), len(text(1000))
+    (True, 1000)
+    """
+    r = random.Random(seed)
+    s = []
+    k = 0
+    while k < n:
+        w = r.choice(_WORDS) + ' '
+        s.append(w)
+        k += len(w)
+    return ''.join(s)[:n]
+
+# name -> setup(cls, n) returning the arguments of op, and op
+BENCHMARKS = {}
+
+def benchmark(name, setup):
+    def register(op):
+        BENCHMARKS[name] = (setup, op)
+        return op
+    return register
+
+def _one(cls, n):
+    return (cls(text(n)),)
+
+def _pair(cls, n):
+    # equal contents, but not the same object
+    return cls(text(n)), cls(text(n) + '.')[:n]
+
+def _pair_late(cls, n):
+    s = text(n)
+    return cls(s), cls(s[:-1] + '#')
+
+def _parts(cls, n):
+    return cls(' '), cls(text(n)).split(' ')
+
+@benchmark('construct', lambda cls, n: (cls, text(n)))
+def _construct(cls, s):
+    return cls(s)
+
+@benchmark('slice', _one)
+def _slice(s):
+    n = len(s)
+    return s[n // 4:3 * n // 4]
+
+@benchmark('eq', _pair)
+def _eq(a, b):
+    return a == b
+
+@benchmark('eq_late', _pair_late)
+def _eq_late(a, b):
+    return a == b
+
+@benchmark('split', _one)
+def _split(s):
+    return s.split(' ')
+
+@benchmark('rsplit', _one)
+def _rsplit(s):
+    return s.rsplit(' ', 8)
+
+@benchmark('replace', _one)
+def _replace(s):
+    return s.replace('ab', 'xyz')
+
+@benchmark('join', _parts)
+def _join(sep, parts):
+    return sep.join(parts)
+
+@benchmark('add_chain', lambda cls, n: (cls(''), cls(text(n)).split(' ')[:64]))
+def _add_chain(acc, parts):
+    for p in parts:
+        acc = acc + p
+    return acc
+
+@benchmark('iterate', _one)
+def _iterate(s):
+    for c in s:
+        pass
+
+def measure(op, args):
+    "Returns the best time of one call in seconds and its peak allocation."
+    t = timeit.Timer(lambda: op(*args))
+    number, _ = t.autorange()
+    best = min(t.repeat(REPEAT, number)) / number
+    tracemalloc.start()
+    try:
+        op(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+def run(names=None, sizes=SIZES):
+    "Runs the benchmarks and returns a list of result dicts."
+    results = []
+    with recording(NullSink()):
+        for name in names or BENCHMARKS:
+            setup, op = BENCHMARKS[name]
+            for n in sizes:
+                str_s, str_peak = measure(op, setup(str, n))
+                tstr_s, tstr_peak = measure(op, setup(tstr, n))
+                results.append({'name': name, 'size': n,
+                    'str_ns': str_s * 1e9, 'tstr_ns': tstr_s * 1e9,
+                    'overhead': tstr_s / str_s,
+                    'str_peak': str_peak, 'tstr_peak': tstr_peak})
+    return results
+
+# operations whose comparisons are logged: name -> op on a tstr of size n
+GROWTH = {
+    'eq': lambda s: s == str(s),
+    'in': lambda s: 'zz' in s,
+    'split': lambda s: s.split(' '),
+    'replace': lambda s: s.replace('ab', 'x'),
+}
+
+def growth(sizes=SIZES):
+    """
+    Measures how many entries each operation adds to Comparisons and how
+    many bytes the log holds on to per entry.
+    """
+    results = []
+    for name, op in GROWTH.items():
+        for n in sizes:
+            s = tstr(text(n))
+            saved = taintedstr.Comparisons[:]
+            del taintedstr.Comparisons[:]
+            tracemalloc.start()
+            try:
+                before, _ = tracemalloc.get_traced_memory()
+                op(s)
+                after, _ = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            entries = len(taintedstr.Comparisons)
+            taintedstr.Comparisons[:] = saved
+            results.append({'name': name, 'size': n, 'entries': entries,
+                'bytes': after - before,
+                'bytes_per_entry': (after - before) / entries if entries else 0})
+    return results
+
+def check(results, baseline=None, tolerance=TOLERANCE):
+    """
+    Returns the regressions in results as a list of messages.
+    >>> r = [{'name': 'slice', 'size': 16, 'tstr_ns': 900.0, 'overhead': 3.0}]
+    >>> check(r)
+    []
+    >>> check(r, [{'name': 'slice', 'size': 16, 'tstr_ns': 600.0, 'overhead': 2.0}])
+    ['slice/16: 900ns is 1.50x the baseline 600ns']
+    >>> check([dict(r[0], overhead=300.0)])
+    ['slice/16: 300.0x str exceeds 40x']
+    """
+    failures = []
+    old = {(b['name'], b['size']): b for b in baseline or ()}
+    for r in results:
+        key = '%s/%d' % (r['name'], r['size'])
+        limit = MAX_OVERHEAD.get(r['name'])
+        if limit is not None and r['overhead'] > limit:
+            failures.append('%s: %.1fx str exceeds %dx' % (key, r['overhead'], limit))
+        b = old.get((r['name'], r['size']))
+        if b and r['tstr_ns'] > b['tstr_ns'] * tolerance:
+            failures.append('%s: %dns is %.2fx the baseline %dns' % (key,
+                r['tstr_ns'], r['tstr_ns'] / b['tstr_ns'], b['tstr_ns']))
+    return failures
+
+def report(results, grown, out=sys.stdout):
+    print('%-10s %6s %12s %12s %9s %10s %10s' % ('benchmark', 'size',
+        'str ns', 'tstr ns', 'overhead', 'str peak', 'tstr peak'), file=out)
+    for r in results:
+        print('%-10s %6d %12.0f %12.0f %8.1fx %10d %10d' % (r['name'],
+            r['size'], r['str_ns'], r['tstr_ns'], r['overhead'],
+            r['str_peak'], r['tstr_peak']), file=out)
+    print(file=out)
+    print('%-10s %6s %9s %10s %9s' % ('logged', 'size', 'entries',
+        'bytes', 'per entry'), file=out)
+    for g in grown:
+        print('%-10s %6d %9d %10d %9.0f' % (g['name'], g['size'],
+            g['entries'], g['bytes'], g['bytes_per_entry']), file=out)
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    p.add_argument('names', nargs='*', help='benchmarks to run (default: all)')
+    p.add_argument('--quick', action='store_true', help='skip the largest size')
+    p.add_argument('--json', help='write the results to this file')
+    p.add_argument('--baseline', help='compare against the results in this file')
+    p.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = p.parse_args(argv)
+    sizes = QUICK_SIZES if args.quick else SIZES
+    results = run(args.names, sizes)
+    grown = growth(sizes)
+    report(results, grown)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                'machine': platform.machine(),
+                'results': results, 'comparisons': grown}, f, indent=1)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    failures = check(results, baseline, args.tolerance)
+    for msg in failures:
+        print('REGRESSION', msg, file=sys.stderr)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+import collections
+import concurrent.futures
+import itertools
+import os
+
+from taintedstr import tstr, taint_session, RecordStore
+
+# One traced input: its position in the batch, the input, what the traced
+# callable returned (or raised), and its comparison log as a RecordStore.
+Trace = collections.namedtuple('Trace', ['index', 'value', 'result', 'error', 'log'])
+
+def trace_one(fn, value, index=0, provenance='none'):
+    """
+    Runs fn on value wrapped as a tstr in a fresh tracing session.
+    >>> t = trace_one(tstr.split, 'ab cd')
+    >>> t.result, t.error, len(t.log), t.log[0]
+    (['ab', 'cd'], None, 1, ?,'ab cd',' ')
+
+    The log is what workers send back, and it keeps the taint of each
+    operand across pickling.
+    >>> import pickle
+    >>> t = pickle.loads(pickle.dumps(trace_one(lambda s: '-' in s[3:] + s[:2], 'abcdef')))
+    >>> t.log[0].opA, t.log[0].opA._taint
+    ('defab', [3, 4, 5, 0, 1])
+    """
+    log = RecordStore()
+    result = error = None
+    with taint_session(log, provenance):
+        try:
+            result = fn(tstr(value))
+        except Exception as e:
+            error = e
+    return Trace(index, value, result, error, log)
+
+def _trace_chunk(fn, chunk, provenance):
+    return [trace_one(fn, v, i, provenance) for i, v in chunk]
+
+def _chunks(inputs, chunksize):
+    it = enumerate(inputs)
+    while True:
+        chunk = list(itertools.islice(it, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+def trace_batch(fn, inputs, executor=None, max_workers=None, chunksize=16,
+        ordered=True, mp_context=None, provenance='none'):
+    """
+    Traces fn over each of the inputs in a process pool and yields a Trace
+    for each, in input order, or as they complete when ordered is False.
+    fn and the inputs have to be picklable. Pass an executor to reuse its
+    workers across batches; otherwise a pool is created for the batch.
+    >>> traces = trace_batch(tstr.split, ['a b', 'c d e', 'f'], chunksize=2)
+    >>> [(t.index, len(t.result), len(t.log)) for t in traces]
+    [(0, 2, 1), (1, 3, 1), (2, 1, 1)]
+    """
+    own = executor is None
+    if own:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers,
+                mp_context=mp_context)
+    try:
+        futures = (executor.submit(_trace_chunk, fn, chunk, provenance)
+                for chunk in _chunks(inputs, chunksize))
+        if ordered:
+            # keep a bounded window of chunks in flight
+            inflight = 2 * (max_workers or os.cpu_count() or 1)
+            window = collections.deque()
+            for f in futures:
+                window.append(f)
+                if len(window) > inflight:
+                    yield from window.popleft().result()
+            while window:
+                yield from window.popleft().result()
+        else:
+            for f in concurrent.futures.as_completed(list(futures)):
+                yield from f.result()
+    finally:
+        if own:
+            executor.shutdown()
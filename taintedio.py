@@ -0,0 +1,174 @@
+"""
+Tainted input read lazily from memory mapped files. The taint of each
+character is the offset of its first byte in the file, plus the base
+the file was given in an OriginTable, so pieces from several files can
+be concatenated and still be traced back to their source.
+
+>>> import tempfile, os
+>>> fd, path = tempfile.mkstemp()
+>>> _ = os.write(fd, 'héllo\\nworld\\n'.encode('utf-8')); os.close(fd)
+>>> with TaintedFile(path) as f:
+...     a, b = f.lines()
+>>> a, a._taint
+('héllo\\n', [0, 1, 3, 4, 5, 6])
+>>> b[0].x(), origins.resolve(b[0].x()) == (path, 7)
+(7, True)
+>>> os.remove(path)
+"""
+import bisect
+import codecs
+import mmap
+import os
+
+from taintedstr import tbytes, RunTaint
+
+class OriginTable:
+    """
+    Gives each source a base offset, so that the taint of every source
+    occupies its own range.
+    >>> t = OriginTable()
+    >>> t.register('a', 10), t.register('b', 5), t.register('a', 10)
+    (0, 10, 0)
+    >>> t.resolve(12)
+    ('b', 2)
+    """
+    def __init__(self):
+        self._names = []
+        self._bases = []
+        self._ids = {}
+        self._next = 0
+
+    def register(self, name, size):
+        if name in self._ids:
+            return self._bases[self._ids[name]]
+        self._ids[name] = len(self._names)
+        self._names.append(name)
+        self._bases.append(self._next)
+        base, self._next = self._next, self._next + size
+        return base
+
+    def base(self, name):
+        return self._bases[self._ids[name]]
+
+    def resolve(self, taint):
+        # the source and the offset within it of a taint value
+        if taint < 0:
+            return None
+        i = bisect.bisect_right(self._bases, taint) - 1
+        return self._names[i], taint - self._bases[i]
+
+origins = OriginTable()
+
+def _ascii_compatible(encoding):
+    return '\n\r azAZ09'.encode(encoding) == b'\n\r azAZ09'
+
+def decode(data, offset=0, encoding='utf-8', errors='strict'):
+    """
+    Decodes data to a tstr whose taint is offset plus the position of the
+    first byte of each character.
+    >>> decode('aé€b'.encode('utf-8'), 100)._taint
+    [100, 101, 103, 106]
+    >>> decode('ab'.encode('utf-16-le'), encoding='utf-16-le')._taint
+    [0, 2]
+    """
+    return tbytes(data, RunTaint.identity(len(data), offset)).decode(encoding, errors)
+
+class TaintedFile:
+    """
+    A memory mapped file that yields tainted lines or chunks on demand.
+    >>> import tempfile, os
+    >>> fd, path = tempfile.mkstemp()
+    >>> _ = os.write(fd, b'abcdefgh'); os.close(fd)
+    >>> with TaintedFile(path, origins=OriginTable()) as f:
+    ...     [(c, c.x()) for c in f.chunks(3)]
+    [('abc', 0), ('def', 3), ('gh', 6)]
+
+    Lines are split on the byte b'\\n', so the encoding has to be ASCII
+    compatible; chunks end on whole characters of the encoding.
+    >>> _ = open(path, 'wb').write('aé€b'.encode('cp1252'))
+    >>> with TaintedFile(path, 'cp1252', origins=OriginTable()) as f:
+    ...     [(c, c.x()) for c in f.chunks(2)]
+    [('aé', 0), ('€b', 2)]
+    >>> _ = open(path, 'wb').write('日本語'.encode('shift_jis'))
+    >>> with TaintedFile(path, 'shift_jis', origins=OriginTable()) as f:
+    ...     [(c, c.x()) for c in f.chunks(3)]
+    [('日', 0), ('本', 2), ('語', 4)]
+    >>> TaintedFile(path, 'utf-16-le')
+    Traceback (most recent call last):
+    ...
+    ValueError: utf-16-le is not ASCII compatible
+    >>> os.remove(path)
+    """
+    def __init__(self, path, encoding='utf-8', errors='strict', origins=origins):
+        if not _ascii_compatible(encoding):
+            raise ValueError('%s is not ASCII compatible' % encoding)
+        self.path = path
+        self.encoding = encoding
+        self.errors = errors
+        self._f = open(path, 'rb')
+        size = os.fstat(self._f.fileno()).st_size
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self.base = origins.register(os.path.abspath(path), size)
+
+    def _decode(self, start, end):
+        return decode(self._mm[start:end], self.base + start, self.encoding, self.errors)
+
+    def lines(self, keepends=True):
+        mm = self._mm
+        pos = 0
+        while pos < len(mm):
+            end = mm.find(b'\n', pos)
+            end = len(mm) if end < 0 else end + 1
+            line = self._decode(pos, end)
+            yield line if keepends or not line.endswith('\n') else line[:-1]
+            pos = end
+
+    def __iter__(self):
+        return self.lines()
+
+    def chunks(self, size):
+        mm = self._mm
+        utf8 = codecs.lookup(self.encoding).name == 'utf-8'
+        pos = 0
+        while pos < len(mm):
+            end = min(pos + size, len(mm))
+            if utf8:
+                # do not cut a utf-8 sequence in two
+                while pos < end < len(mm) and mm[end] & 0xC0 == 0x80:
+                    end -= 1
+                if end == pos:
+                    # a single character longer than size
+                    end = pos + 1
+                    while end < len(mm) and mm[end] & 0xC0 == 0x80:
+                        end += 1
+            elif end < len(mm):
+                end = self._boundary(pos, end)
+            yield self._decode(pos, end)
+            pos = end
+
+    def _boundary(self, pos, end):
+        # the end of the last whole character in pos..end, or of the
+        # first one when it is longer than that, by the bytes an
+        # incremental decoder holds back
+        dec = codecs.getincrementaldecoder(self.encoding)(self.errors)
+        dec.decode(self._mm[pos:end])
+        held = len(dec.getstate()[0])
+        if held < end - pos:
+            return end - held
+        while end < len(self._mm):
+            end += 1
+            dec.decode(self._mm[end - 1:end])
+            if not dec.getstate()[0]:
+                break
+        return end
+
+    def close(self):
+        if self._mm:
+            self._mm.close()
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,162 @@
+"""
+Opt-in profiling of the tstr methods. While enabled, every method defined
+on tstr and tbytes is replaced with a counting wrapper, and the comparison
+recorders count each Op. Disabling puts the original functions back, so a
+disabled profiler costs nothing.
+
+>>> with profiling() as p:
+...     _ = tstr('ab cd').split(' ')
+...     _ = tstr('ab') == 'ab'
+>>> s = p.snapshot()
+>>> s['methods']['tstr.split']['calls'], s['methods']['tstr.split']['chars']
+(1, 5)
+>>> s['methods']['tstr.split']['taint']
+4
+>>> s['ops']['EQ'], s['ops']['IN']
+(2, 1)
+>>> 'tstr.split' in p.report()
+True
+"""
+import collections
+import sys
+import time
+
+import taintedstr
+from taintedstr import tstr, tbytes
+
+# the counting wrappers are not call sites of comparisons
+taintedstr._INTERNAL.add(__file__)
+
+# the counters kept for each method
+FIELDS = ('calls', 'chars', 'taint', 'ns')
+
+# methods the wrappers themselves rely on, and private helpers
+_SKIP = {'__new__', '__init__', '__len__', '__setattr__', '__getattribute__',
+        '__hash__', '__repr__', '__str__', '__reduce__', '__class__'}
+
+def _profiled(name):
+    if name in _SKIP:
+        return False
+    return not name.startswith('_') or name.startswith('__')
+
+def _size(v):
+    # taint entries carried by a result
+    if isinstance(v, (tstr, tbytes)):
+        return len(v)
+    if isinstance(v, (list, tuple)):
+        return sum(len(x) for x in v if isinstance(x, (tstr, tbytes)))
+    return 0
+
+class Profile:
+    """
+    Counters for one profiling run: per method the number of calls, the
+    characters of the receivers, the taint entries of the results, and
+    the time spent (including nested calls), and per Op the comparisons
+    recorded.
+    """
+    def __init__(self):
+        self.methods = collections.defaultdict(lambda: [0, 0, 0, 0])
+        self.ops = collections.Counter()
+        self._saved = None
+
+    def _wrap(self, key, fn):
+        c = self.methods[key]
+        clock = time.perf_counter_ns
+        def counted(this, *args, **kwargs):
+            t = clock()
+            try:
+                res = fn(this, *args, **kwargs)
+            finally:
+                c[3] += clock() - t
+            c[0] += 1
+            c[1] += len(this)
+            c[2] += _size(res)
+            return res
+        counted.__name__ = fn.__name__
+        counted.__doc__ = fn.__doc__
+        counted.__wrapped__ = fn
+        return counted
+
+    def _count(self, fn):
+        ops = self.ops
+        def record(op, a, b):
+            ops[op] += 1
+            fn(op, a, b)
+        return record
+
+    def _count_chars(self, fn):
+        ops = self.ops
+        def record_chars(op, a, b, start, stop):
+            ops[op] += stop - start
+            fn(op, a, b, start, stop)
+        return record_chars
+
+    def enable(self):
+        if self._saved is not None:
+            return
+        saved = []
+        for cls in (tstr, tbytes):
+            for name, fn in list(vars(cls).items()):
+                if (_profiled(name) and callable(fn)
+                        and not isinstance(fn, (type, staticmethod))):
+                    saved.append((cls, name, fn))
+                    setattr(cls, name, self._wrap('%s.%s' % (cls.__name__, name), fn))
+        # modules that imported the recorders by name are patched as well
+        record, record_chars = taintedstr._record, taintedstr._record_chars
+        for m in list(sys.modules.values()):
+            d = getattr(m, '__dict__', {})
+            for name, fn, wrap in (('_record', record, self._count),
+                    ('_record_chars', record_chars, self._count_chars)):
+                if d.get(name) is fn:
+                    saved.append((m, name, fn))
+                    setattr(m, name, wrap(fn))
+        self._saved = saved
+
+    def disable(self):
+        if self._saved is None:
+            return
+        for owner, name, fn in self._saved:
+            setattr(owner, name, fn)
+        self._saved = None
+
+    def reset(self):
+        for c in self.methods.values():
+            c[:] = [0, 0, 0, 0]
+        self.ops.clear()
+
+    def snapshot(self):
+        "The counters as plain dicts, leaving out the methods never called."
+        return {
+            'methods': {k: dict(zip(FIELDS, c))
+                for k, c in self.methods.items() if c[0]},
+            'ops': {op.name: n for op, n in self.ops.items()},
+        }
+
+    def report(self, sort='ns', limit=None):
+        "A text table of the methods, the most expensive first."
+        rows = sorted(self.snapshot()['methods'].items(),
+                key=lambda kv: kv[1][sort], reverse=True)[:limit]
+        out = ['%-24s %9s %11s %11s %12s %9s' % ('method', 'calls', 'chars',
+            'taint', 'total us', 'per call')]
+        for k, c in rows:
+            out.append('%-24s %9d %11d %11d %12.1f %9.2f' % (k, c['calls'],
+                c['chars'], c['taint'], c['ns'] / 1e3, c['ns'] / 1e3 / c['calls']))
+        out.append('')
+        out.append('%-24s %9s' % ('op', 'recorded'))
+        for op, n in self.ops.most_common():
+            out.append('%-24s %9d' % (op.name, n))
+        return '\n'.join(out)
+
+    def __enter__(self):
+        self.enable()
+        return self
+
+    def __exit__(self, *exc):
+        self.disable()
+
+def profiling():
+    """
+    Profiles the tstr methods for the duration of a with block. Profiling
+    patches the classes, so it covers all threads while it is enabled.
+    """
+    return Profile()
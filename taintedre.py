@@ -0,0 +1,288 @@
+"""
+A drop in for the re module that keeps the taint of the strings it
+works on. Groups of a match on a tstr are tstr slices of the subject,
+sub() and split() build tstrs, and every match attempt on a tstr is
+recorded as a comparison of the matched (or searched) span against the
+pattern: an Op.RE_MATCH when it matched, and an Op.RE_NO_MATCH when it
+did not. The outcome is the one of the match itself, so flags and the
+context around the span count.
+
+>>> my_str = tstr('key=value')
+>>> m = search(r'(\\w+)=(\\w+)', my_str)
+>>> m.group(2), m.group(2).x()
+('value', 4)
+>>> [str(i) for i in taintedstr.Comparisons[-1:]]
+["'key=value' =~ '(\\\\\\\\w+)=(\\\\\\\\w+)'"]
+>>> _ = compile('a b', X).match(tstr('ab'))
+>>> _ = search(r'(?<=x)a', tstr('xa'))
+>>> _ = match('x', my_str)
+>>> [str(i) for i in taintedstr.Comparisons[-3:]]
+["'ab' =~ 'a b'", "'a' =~ '(?<=x)a'", "'key=value' !~ 'x'"]
+>>> v = sub(r'(\\w+)=(\\w+)', r'\\2:\\1', my_str)
+>>> v, v._taint
+('value:key', [4, 5, 6, 7, 8, -1, 0, 1, 2])
+"""
+import functools
+import re
+from re import (A, I, L, M, S, U, X, ASCII, IGNORECASE, LOCALE, MULTILINE,
+        DOTALL, UNICODE, VERBOSE, error, escape)
+
+import taintedstr
+from taintedstr import tstr, Op, TaintedStringBuilder, _record
+
+CACHE_SIZE = 512
+
+# comparisons are attributed to the caller of this module
+taintedstr._INTERNAL.add(__file__)
+
+class TaintedMatch:
+    # wraps a re.Match, and returns the groups as slices of the subject
+    def __init__(self, m, string):
+        self._m = m
+        self.string = string
+        self.re = m.re
+        self.pos = m.pos
+        self.endpos = m.endpos
+        self.lastindex = m.lastindex
+        self.lastgroup = m.lastgroup
+
+    def __repr__(self):
+        return '<tainted %r>' % self._m
+
+    def _group(self, g):
+        start, end = self._m.span(g)
+        if start < 0:
+            return None
+        return self.string[start:end]
+
+    def group(self, *gs):
+        if len(gs) <= 1:
+            return self._group(gs[0] if gs else 0)
+        return tuple(self._group(g) for g in gs)
+
+    def __getitem__(self, g):
+        return self._group(g)
+
+    def groups(self, default=None):
+        return tuple(default if g is None else g
+                for g in (self._group(i) for i in range(1, self.re.groups + 1)))
+
+    def groupdict(self, default=None):
+        return {k: default if v is None else v
+                for k, v in ((k, self._group(k)) for k in self.re.groupindex)}
+
+    def start(self, g=0):
+        return self._m.start(g)
+
+    def end(self, g=0):
+        return self._m.end(g)
+
+    def span(self, g=0):
+        return self._m.span(g)
+
+    def expand(self, template):
+        return _expand(self, _template(template, self.re))
+
+# sub() templates split into literal text and (group,) references
+def _parse_template(repl):
+    parts = []
+    lit = 0
+    i = 0
+    while True:
+        i = repl.find('\\', i)
+        if i < 0 or i + 1 >= len(repl):
+            break
+        c, end, g = repl[i+1], i + 2, None
+        if c == 'g' and repl.startswith('<', i + 2) and repl.find('>', i) > 0:
+            end = repl.find('>', i) + 1
+            name = repl[i+3:end-1]
+            g = int(name) if name.isdigit() else name
+        elif c in '123456789':
+            nxt = repl[i+2:i+4]
+            if len(nxt) == 2 and c in '01234567' and all(d in '01234567' for d in nxt):
+                end = i + 4 # an octal escape
+            elif nxt[:1].isdigit():
+                g, end = int(repl[i+1:i+3]), i + 3
+            else:
+                g = int(c)
+        if g is not None:
+            parts.append(repl[lit:i])
+            parts.append((g,))
+            lit = end
+        i = end
+    parts.append(repl[lit:])
+    return parts
+
+_EMPTY = re.compile('')
+
+def _template(repl, pattern):
+    # re checks the template first, so that bad templates fail the same
+    # way. The literal parts still hold escapes, which re expands.
+    pattern.sub(repl, '', 1)
+    return [_EMPTY.sub(p, '', 1) if type(p) is str and p else p
+            for p in _parse_template(str(repl))]
+
+def _expand(m, template):
+    b = TaintedStringBuilder()
+    for p in template:
+        if type(p) is str:
+            b.write(p)
+        else:
+            g = m.group(p[0])
+            if g is not None:
+                b.write(g)
+    return b.getvalue()
+
+class TaintedPattern:
+    def __init__(self, pattern, flags=0):
+        self._re = pattern if isinstance(pattern, re.Pattern) else re.compile(pattern, flags)
+        self.pattern = self._re.pattern
+        self.flags = self._re.flags
+        self.groups = self._re.groups
+        self.groupindex = self._re.groupindex
+
+    def __repr__(self):
+        return 'tainted %r' % self._re
+
+    def _wrap(self, m, string, pos, endpos):
+        if type(string) is not tstr:
+            return None if m is None else TaintedMatch(m, string)
+        if m is None:
+            _record(Op.RE_NO_MATCH, string[pos:endpos], self.pattern)
+            return None
+        _record(Op.RE_MATCH, string[m.start():m.end()], self.pattern)
+        return TaintedMatch(m, string)
+
+    def search(self, string, pos=0, endpos=None):
+        endpos = len(string) if endpos is None else endpos
+        return self._wrap(self._re.search(string, pos, endpos), string, pos, endpos)
+
+    def match(self, string, pos=0, endpos=None):
+        endpos = len(string) if endpos is None else endpos
+        return self._wrap(self._re.match(string, pos, endpos), string, pos, endpos)
+
+    def fullmatch(self, string, pos=0, endpos=None):
+        endpos = len(string) if endpos is None else endpos
+        return self._wrap(self._re.fullmatch(string, pos, endpos), string, pos, endpos)
+
+    def finditer(self, string, pos=0, endpos=None):
+        endpos = len(string) if endpos is None else endpos
+        for m in self._re.finditer(string, pos, endpos):
+            yield self._wrap(m, string, pos, endpos)
+
+    def findall(self, string, pos=0, endpos=None):
+        """
+        >>> my_str = tstr('a1b22')
+        >>> [(v, v.x()) for v in compile(r'\\d+').findall(my_str)]
+        [('1', 1), ('22', 3)]
+        >>> compile(r'([a-z])(\\d)').findall(my_str)
+        [('a', '1'), ('b', '2')]
+        """
+        res = []
+        for m in self.finditer(string, pos, endpos):
+            if self.groups == 0:
+                res.append(m.group())
+            elif self.groups == 1:
+                res.append(m.groups(string[0:0])[0])
+            else:
+                res.append(m.groups(string[0:0]))
+        return res
+
+    def subn(self, repl, string, count=0):
+        """
+        >>> my_str = tstr('a-b-c')
+        >>> v, n = compile('-').subn(lambda m: '+', my_str, 1)
+        >>> v, v._taint, n
+        ('a+b-c', [0, -1, 2, 3, 4], 1)
+
+        Matches past count are not recorded.
+        >>> with taintedstr.recording(taintedstr.ListSink()) as log:
+        ...     _ = compile('-').sub('+', my_str, 1)
+        >>> len(log)
+        1
+        """
+        if type(string) is not tstr:
+            return self._re.subn(repl, string, count)
+        b = TaintedStringBuilder()
+        template = None if callable(repl) else _template(repl, self._re)
+        last = n = 0
+        for m in self._re.finditer(string):
+            if count and n >= count:
+                break
+            m = self._wrap(m, string, 0, len(string))
+            b.write(string[last:m.start()])
+            if template is None:
+                b.write(repl(m))
+            else:
+                b.write(_expand(m, template))
+            last = m.end()
+            n += 1
+        b.write(string[last:])
+        return b.getvalue(string), n
+
+    def sub(self, repl, string, count=0):
+        return self.subn(repl, string, count)[0]
+
+    def split(self, string, maxsplit=0):
+        """
+        >>> my_str = tstr('a, b,c')
+        >>> [(v, v.x()) for v in compile(r',\\s*').split(my_str)]
+        [('a', 0), ('b', 3), ('c', 5)]
+        >>> with taintedstr.recording(taintedstr.ListSink()) as log:
+        ...     _ = compile(r',\\s*').split(my_str, 1)
+        >>> len(log)
+        1
+        """
+        if type(string) is not tstr:
+            return self._re.split(string, maxsplit)
+        res = []
+        last = n = 0
+        for m in self._re.finditer(string):
+            if maxsplit and n >= maxsplit:
+                break
+            m = self._wrap(m, string, 0, len(string))
+            res.append(string[last:m.start()])
+            res.extend(m.group(g) for g in range(1, self.groups + 1))
+            last = m.end()
+            n += 1
+        res.append(string[last:])
+        return res
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _compile(pattern, flags):
+    return TaintedPattern(pattern, flags)
+
+def compile(pattern, flags=0):
+    if isinstance(pattern, TaintedPattern):
+        return pattern
+    if isinstance(pattern, re.Pattern):
+        return TaintedPattern(pattern)
+    return _compile(pattern, flags)
+
+def purge():
+    _compile.cache_clear()
+    re.purge()
+
+def search(pattern, string, flags=0):
+    return compile(pattern, flags).search(string)
+
+def match(pattern, string, flags=0):
+    return compile(pattern, flags).match(string)
+
+def fullmatch(pattern, string, flags=0):
+    return compile(pattern, flags).fullmatch(string)
+
+def finditer(pattern, string, flags=0):
+    return compile(pattern, flags).finditer(string)
+
+def findall(pattern, string, flags=0):
+    return compile(pattern, flags).findall(string)
+
+def sub(pattern, repl, string, count=0, flags=0):
+    return compile(pattern, flags).sub(repl, string, count)
+
+def subn(pattern, repl, string, count=0, flags=0):
+    return compile(pattern, flags).subn(repl, string, count)
+
+def split(pattern, string, maxsplit=0, flags=0):
+    return compile(pattern, flags).split(string, maxsplit)
@@ -1,5 +1,24 @@
-import inspect
+import abc
 import enum
+import bisect
+import array
+import codecs
+import collections
+import contextlib
+import contextvars
+import functools
+import itertools
+import json
+import random
+import re
+import struct
+import sys
+import weakref
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class Op(enum.Enum):
     LT = 0
@@ -13,6 +32,8 @@ class Op(enum.Enum):
     IS = enum.auto()
     IS_NOT = enum.auto()
     FIND_STR = enum.auto()
+    RE_MATCH = enum.auto()
+    RE_NO_MATCH = enum.auto()
 
 COMPARE_OPERATORS = {
         Op.EQ: lambda x, y: x == y,
@@ -25,11 +46,552 @@ COMPARE_OPERATORS = {
 class TaintException(Exception):
     pass
 
+# raised by the sinks that can not mark their log and roll it back
+class RollbackError(TaintException):
+    pass
+
+# A taint map maps each character index of a tstr to the index of the
+# input character it came from (-1 when the character is not tainted).
+# Maps are immutable, so derived strings can share them freely.
+# The summary of a map is computed once, on first use, and carried over
+# to concatenations and slices where that is cheap.
+class TaintList(list):
+    """
+    A list of the taint of each character that can not be changed in
+    place. Assign a new list to _taint to change the taint of a string.
+    >>> t = tstr('abc')._taint
+    >>> t, t == [0, 1, 2]
+    ([0, 1, 2], True)
+    >>> t[0] = 7
+    Traceback (most recent call last):
+    ...
+    TypeError: the taint list is read only; assign a new list to _taint
+    """
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('the taint list is read only; assign a new list to _taint')
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = clear = sort = reverse = _read_only
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+# The lists last made by TaintMap.aslist, so that indexing _taint in a
+# loop does not rebuild the list on each access. Only a few are kept, so
+# a read of _taint does not keep the list alive as long as its map.
+TAINT_LIST_CACHE = 8
+
+@functools.lru_cache(maxsize=TAINT_LIST_CACHE)
+def _taint_list(t):
+    return TaintList(t.tolist())
+
+class TaintMap(abc.ABC):
+    __slots__ = ('_summary', '_inverse')
+
+    @abc.abstractmethod
+    def __len__(self):
+        pass
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self.tolist())
+
+    @abc.abstractmethod
+    def tolist(self):
+        pass
+
+    def aslist(self):
+        "The taint as a read only list; the last few made are reused."
+        return _taint_list(self)
+
+    def summary(self):
+        s = self._summary
+        if s is None:
+            s = self._summary = self._summarize()
+        return s
+
+    def _summarize(self):
+        first_idx = first = lo = hi = -1
+        for i, v in enumerate(self):
+            if v < 0:
+                continue
+            if first_idx < 0:
+                first_idx, first, lo, hi = i, v, v, v
+            elif v < lo:
+                lo = v
+            elif v > hi:
+                hi = v
+        return TaintSummary(first_idx, first, lo, hi)
+
+    def has_taint(self):
+        return self.summary().first_idx >= 0
+
+    def first_tainted(self):
+        return self.summary().first
+
+    def contains(self, tpos):
+        s = self.summary()
+        if tpos < 0 or not s.lo <= tpos <= s.hi:
+            return False
+        return self.index_of(tpos) >= 0
+
+    # the first local index that maps to input index tpos, or -1
+    def index_of(self, tpos):
+        if self._inverse is None:
+            inv = {}
+            for i, v in enumerate(self):
+                if v >= 0 and v not in inv:
+                    inv[v] = i
+            self._inverse = inv
+        return self._inverse.get(tpos, -1)
+
+    def toarray(self):
+        return _array(self)
+
+    def concat(self, other):
+        a, b = self.toarray(), other.toarray()
+        if a.typecode != b.typecode:
+            a, b = array.array('q', a), array.array('q', b)
+        a.extend(b)
+        return self._joined(ArrayTaint(a), other)
+
+    def _joined(self, t, other):
+        # summary of self + other from the summaries of the parts
+        a, b = self._summary, other._summary
+        if a is not None and b is not None:
+            if a.first_idx < 0:
+                t._summary = b._replace(first_idx=b.first_idx + len(self)) \
+                        if b.first_idx >= 0 else b
+            elif b.first_idx < 0:
+                t._summary = a
+            else:
+                t._summary = a._replace(lo=min(a.lo, b.lo), hi=max(a.hi, b.hi))
+        return t
+
+    def _sliced(self, t):
+        # a slice of an untainted map is untainted
+        s = self._summary
+        if s is not None and s.first_idx < 0:
+            t._summary = s
+        return t
+
+    def _index(self, key):
+        n = len(self)
+        if key < 0:
+            key += n
+        if not 0 <= key < n:
+            raise IndexError('taint index out of range')
+        return key
+
+# first_idx is the local index of the first tainted character, first its
+# input index, and lo and hi the smallest and largest input index (all -1
+# when the map carries no taint).
+TaintSummary = collections.namedtuple('TaintSummary', ['first_idx', 'first', 'lo', 'hi'])
+
+# Varints: seven bits a byte, low bits first, with the high bit set on
+# all but the last byte. Signed values are zigzag encoded first.
+def _put_uint(buf, n):
+    while n > 0x7f:
+        buf.append((n & 0x7f) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+def _put_int(buf, n):
+    _put_uint(buf, (n << 1) if n >= 0 else ((-n << 1) - 1))
+
+def _get_uint(buf, pos):
+    n = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+def _get_int(buf, pos):
+    n, pos = _get_uint(buf, pos)
+    return (n >> 1) if not n & 1 else -((n + 1) >> 1), pos
+
+def encode_taint(t, buf=None):
+    """
+    Appends the runs of taint map t to buf (a new bytearray by default)
+    as varints: the number of runs, then the length, origin and step of
+    each.
+    >>> b = encode_taint(RunTaint.identity(1000, 5).concat(RunTaint.constant(3)))
+    >>> bytes(b)
+    b'\\x02\\xe8\\x07\\n\\x02\\x03\\x01\\x00'
+    >>> t, end = decode_taint(b)
+    >>> t.runs(), end
+    ([(1000, 5, 1), (3, -1, 0)], 8)
+    """
+    if buf is None:
+        buf = bytearray()
+    if type(t) is not RunTaint:
+        t = RunTaint.from_list(t)
+    _put_uint(buf, t.nruns())
+    for length, val, step in t.runs():
+        _put_uint(buf, length)
+        _put_int(buf, val)
+        _put_int(buf, step)
+    return buf
+
+def decode_taint(buf, pos=0):
+    "Reads a taint map written by encode_taint; returns it and the end."
+    n, pos = _get_uint(buf, pos)
+    t = RunTaint([], [], [])
+    end = 0
+    for _ in range(n):
+        length, pos = _get_uint(buf, pos)
+        val, pos = _get_int(buf, pos)
+        step, pos = _get_int(buf, pos)
+        end += length
+        t._ends.append(end)
+        t._vals.append(val)
+        t._steps.append(step)
+    return _compact(t), pos
+
+def _decode_map(data):
+    return decode_taint(data)[0]
+
+class RunTaint(TaintMap):
+    """
+    Stores the taint as runs of (length, origin, step), where a step of 1
+    is a contiguous range of input indexes and a step of 0 repeats origin.
+    >>> t = RunTaint.from_list(list(range(4,10)) + [-1] * 6)
+    >>> t.runs()
+    [(6, 4, 1), (6, -1, 0)]
+    >>> t[5], t[6], t[-1]
+    (9, -1, -1)
+    >>> t[2:8].runs()
+    [(4, 6, 1), (2, -1, 0)]
+    >>> t.concat(RunTaint.identity(2, 10)).runs()
+    [(6, 4, 1), (6, -1, 0), (2, 10, 1)]
+    """
+    __slots__ = ('_ends', '_vals', '_steps')
+
+    def __init__(self, ends, vals, steps):
+        # _ends holds the (exclusive) end index of each run
+        self._ends = ends
+        self._vals = vals
+        self._steps = steps
+        self._summary = None
+        self._inverse = None
+
+    def __reduce__(self):
+        return (_decode_map, (bytes(encode_taint(self)),))
+
+    @classmethod
+    def identity(cls, n, start=0):
+        return cls([n], [start], [1]) if n else cls([], [], [])
+
+    @classmethod
+    def constant(cls, n, value=-1):
+        return cls([n], [value], [0]) if n else cls([], [], [])
+
+    @classmethod
+    def from_list(cls, lst):
+        t = cls([], [], [])
+        for v in lst:
+            t._push(1, v, 0)
+        return t
+
+    def _push(self, length, val, step):
+        # append a run, merging it with the last one when they line up
+        if not length:
+            return
+        ends, vals, steps = self._ends, self._vals, self._steps
+        if ends:
+            plen = ends[-1] - (ends[-2] if len(ends) > 1 else 0)
+            pval = vals[-1]
+            if plen > 1:
+                s = steps[-1]
+            elif length > 1:
+                s = step
+            else:
+                s = val - pval
+            if (s == 0 or (s == 1 and pval >= 0)) and \
+                    (length == 1 or step == s) and val == pval + plen * s:
+                ends[-1] += length
+                steps[-1] = s
+                return
+        ends.append((ends[-1] if ends else 0) + length)
+        vals.append(val)
+        steps.append(step)
+
+    def runs(self):
+        res = []
+        begin = 0
+        for end, val, step in zip(self._ends, self._vals, self._steps):
+            res.append((end - begin, val, step))
+            begin = end
+        return res
+
+    def nruns(self):
+        return len(self._ends)
+
+    def __len__(self):
+        return self._ends[-1] if self._ends else 0
+
+    def __getitem__(self, key):
+        if type(key) is slice:
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return self._sliced(taint_map(self.tolist()[key]))
+            return self._sliced(self._slice(start, stop))
+        key = self._index(key)
+        j = bisect.bisect_right(self._ends, key)
+        begin = self._ends[j-1] if j else 0
+        return self._vals[j] + (key - begin) * self._steps[j]
+
+    def _slice(self, start, stop):
+        t = RunTaint([], [], [])
+        if start >= stop:
+            return t
+        ends = self._ends
+        j = bisect.bisect_right(ends, start)
+        k = bisect.bisect_right(ends, stop - 1)
+        for r in range(j, k + 1):
+            begin = ends[r-1] if r else 0
+            lo, hi = max(begin, start), min(ends[r], stop)
+            t._push(hi - lo, self._vals[r] + (lo - begin) * self._steps[r],
+                    self._steps[r])
+        return t
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(
+                range(val, val + length) if step else itertools.repeat(val, length)
+                for length, val, step in self.runs())
+
+    def tolist(self):
+        res = []
+        for length, val, step in self.runs():
+            if step:
+                res.extend(range(val, val + length))
+            else:
+                res.extend([val] * length)
+        return res
+
+    def _summarize(self):
+        first_idx = first = lo = hi = -1
+        begin = 0
+        for length, val, step in self.runs():
+            if val >= 0:
+                last = val + (length - 1) * step
+                if first_idx < 0:
+                    first_idx, first, lo, hi = begin, val, val, last
+                else:
+                    lo, hi = min(lo, val), max(hi, last)
+            begin += length
+        return TaintSummary(first_idx, first, lo, hi)
+
+    def index_of(self, tpos):
+        """
+        >>> t = RunTaint.identity(4, 10).concat(RunTaint.identity(4, 2))
+        >>> t.index_of(3), t.index_of(12), t.index_of(7), t.contains(13)
+        (5, 2, -1, True)
+        """
+        if self._inverse is None:
+            # the tainted runs as input intervals sorted by their start,
+            # with the running maximum of their ends
+            ivs = []
+            begin = 0
+            for length, val, step in self.runs():
+                if val >= 0:
+                    ivs.append((val, val + (length if step else 1), begin, step))
+                begin += length
+            ivs.sort()
+            ends = list(itertools.accumulate((iv[1] for iv in ivs), max))
+            self._inverse = ([iv[0] for iv in ivs], ends, ivs)
+        starts, ends, ivs = self._inverse
+        best = -1
+        j = bisect.bisect_right(starts, tpos) - 1
+        while j >= 0 and ends[j] > tpos:
+            lo, hi, begin, step = ivs[j]
+            if tpos < hi:
+                i = begin + (tpos - lo) * step
+                if best < 0 or i < best:
+                    best = i
+            j -= 1
+        return best
+
+    def concat(self, other):
+        if type(other) is not RunTaint:
+            return super().concat(other)
+        t = RunTaint(list(self._ends), list(self._vals), list(self._steps))
+        for length, val, step in other.runs():
+            t._push(length, val, step)
+        return self._joined(_compact(t), other)
+
+class ArrayTaint(TaintMap):
+    """
+    Per character taint for maps that do not compress into runs. The taint
+    lives in a typed array, and slices are memoryview windows into the
+    parent buffer rather than copies.
+    >>> t = taint_map([3, 1, 4, 1, 5, 9, 2, 6])
+    >>> t
+    ArrayTaint([3, 1, 4, 1, 5, 9, 2, 6])
+    >>> v = t[2:6]
+    >>> v.tolist(), v[-1]
+    ([4, 1, 5, 9], 9)
+    >>> v._mv.obj is t._mv.obj
+    True
+    >>> v.concat(RunTaint.constant(2)).tolist()
+    [4, 1, 5, 9, -1, -1]
+    """
+    __slots__ = ('_mv',)
+
+    def __init__(self, buf):
+        self._mv = memoryview(buf)
+        self._summary = None
+        self._inverse = None
+
+    def __reduce__(self):
+        return (ArrayTaint, (self.toarray(),))
+
+    def __len__(self):
+        return len(self._mv)
+
+    def __iter__(self):
+        return iter(self._mv)
+
+    def __getitem__(self, key):
+        if type(key) is slice:
+            return self._sliced(ArrayTaint(self._mv[key]))
+        return self._mv[key]
+
+    def tolist(self):
+        return self._mv.tolist()
+
+    def _summarize(self):
+        if not len(self._mv):
+            return UNTAINTED
+        if _use_numpy(len(self._mv)):
+            a = numpy.asarray(self._mv)
+            tainted = numpy.flatnonzero(a >= 0)
+            if not len(tainted):
+                return UNTAINTED
+            t = a[tainted]
+            return TaintSummary(int(tainted[0]), int(t[0]), int(t.min()), int(t.max()))
+        if max(self._mv) < 0:
+            return UNTAINTED
+        return super()._summarize()
+
+    def index_of(self, tpos):
+        if self._inverse is None and _use_numpy(len(self._mv)):
+            vals, first = numpy.unique(numpy.asarray(self._mv), return_index=True)
+            tainted = vals >= 0
+            self._inverse = dict(zip(vals[tainted].tolist(), first[tainted].tolist()))
+        return super().index_of(tpos)
+
+    def toarray(self):
+        a = array.array(self._mv.format)
+        mv = self._mv
+        a.frombytes(mv.cast('B') if mv.contiguous else mv.tobytes())
+        return a
+
+UNTAINTED = TaintSummary(-1, -1, -1, -1)
+
+# Bulk work on maps of at least this many entries is done with numpy when
+# it is installed; the arrays stay the same either way.
+NUMPY_THRESHOLD = 1 << 15
+
+def _use_numpy(n):
+    return numpy is not None and n >= NUMPY_THRESHOLD
+
+def _expand(t):
+    # the entries of a RunTaint as a numpy array: the origin of each run,
+    # repeated, plus the offset into the run times its step
+    ends = numpy.asarray(t._ends, dtype=numpy.int64)
+    lengths = numpy.diff(ends, prepend=0)
+    offsets = numpy.arange(len(t), dtype=numpy.int64) - numpy.repeat(ends - lengths, lengths)
+    return (numpy.repeat(numpy.asarray(t._vals, dtype=numpy.int64), lengths)
+            + offsets * numpy.repeat(numpy.asarray(t._steps, dtype=numpy.int64), lengths))
+
+def _from_numpy(a):
+    # the narrow type unless an offset needs the wide one, as in _array
+    if len(a) and a.max() >= 2**31:
+        res = array.array('q')
+        res.frombytes(a.astype(numpy.int64).tobytes())
+    else:
+        res = array.array(TAINT_TYPECODE)
+        res.frombytes(a.astype(numpy.int32).tobytes())
+    return res
+
+def _array(taint):
+    if type(taint) is RunTaint:
+        if _use_numpy(len(taint)):
+            return _from_numpy(_expand(taint))
+        a = array.array(TAINT_TYPECODE)
+        try:
+            for length, val, step in taint.runs():
+                if step:
+                    a.extend(range(val, val + length))
+                else:
+                    a.extend(array.array(TAINT_TYPECODE, [val]) * length)
+            return a
+        except OverflowError:
+            taint = taint.tolist()
+    try:
+        return array.array(TAINT_TYPECODE, taint)
+    except OverflowError:
+        # offsets past 2**31 need the wide type
+        return array.array('q', taint)
+
+# Maps with more than one run per RUN_DENSITY characters are stored as
+# typed arrays.
+RUN_DENSITY = 4
+TAINT_TYPECODE = 'i'
+
+def _compact(t):
+    if t.nruns() > 1 and t.nruns() * RUN_DENSITY > len(t):
+        return ArrayTaint(_array(t))
+    return t
+
+def concat_maps(maps):
+    """
+    Concatenates any number of maps in one pass.
+    >>> concat_maps([RunTaint.identity(8), RunTaint.constant(2), RunTaint.identity(8, 8)]).runs()
+    [(8, 0, 1), (2, -1, 0), (8, 8, 1)]
+    """
+    if all(type(m) is RunTaint for m in maps):
+        t = RunTaint([], [], [])
+        for m in maps:
+            for run in m.runs():
+                t._push(*run)
+        return _compact(t)
+    if _use_numpy(sum(len(m) for m in maps)):
+        return ArrayTaint(_from_numpy(numpy.concatenate([_expand(m)
+            if type(m) is RunTaint else numpy.asarray(m._mv) for m in maps])))
+    arrays = [m.toarray() for m in maps]
+    typecode = 'q' if any(a.typecode == 'q' for a in arrays) else TAINT_TYPECODE
+    res = array.array(typecode)
+    for a in arrays:
+        res.extend(a if a.typecode == typecode else array.array(typecode, a))
+    return ArrayTaint(res)
+
+def taint_map(taint):
+    """
+    >>> taint_map(list(range(4,16)))
+    RunTaint([4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15])
+    >>> taint_map([3, 1, 4, 1])
+    ArrayTaint([3, 1, 4, 1])
+    """
+    if isinstance(taint, TaintMap):
+        return taint
+    return _compact(RunTaint.from_list(taint))
+
 class Instr:
+    __slots__ = ('opA', 'opB', 'op', 'site')
+
     def __init__(self,o, a, b):
         self.opA = a
         self.opB = b
         self.op = o
+        # id of the call site in call_sites, when captured
+        self.site = -1
 
     def o(self):
         if self.op == Op.EQ:
@@ -76,22 +638,1273 @@ class Instr:
                 return "%s in %s" % (repr(self.opA), repr(self.opB))
             else:
                 return "%s not in %s" %  (repr(self.opA), repr(self.opB))
+        elif self.op == Op.RE_MATCH:
+            return "%s =~ %s" % (repr(self.opA), repr(self.opB))
+        elif self.op == Op.RE_NO_MATCH:
+            return "%s !~ %s" % (repr(self.opA), repr(self.opB))
         else:
             assert False
 
 Comparisons = []
+
+# Sinks receive the comparisons as they are made. A sink only needs a
+# record(op, a, b) method; the default one appends an Instr to the module
+# level Comparisons list.
+class Sink(abc.ABC):
+    @abc.abstractmethod
+    def record(self, op, a, b):
+        pass
+
+    # records op between a[i] and b[i] for each i in start..stop
+    def record_chars(self, op, a, b, start, stop):
+        for i in range(start, stop):
+            self.record(op, a[i], b[i])
+
+    # the same, with the id of the call site in call_sites; sinks that do
+    # not keep call sites ignore it
+    def record_at(self, op, a, b, site):
+        self.record(op, a, b)
+
+    def record_chars_at(self, op, a, b, start, stop, site):
+        self.record_chars(op, a, b, start, stop)
+
+    # A mark is a position in the log that rollback() truncates back to,
+    # in time proportional to what was recorded since. Sinks that hand
+    # the comparisons on as they come raise RollbackError.
+    def mark(self):
+        raise RollbackError('a %s can not roll back' % type(self).__name__)
+
+    def rollback(self, mark):
+        raise RollbackError('a %s can not roll back' % type(self).__name__)
+
+class ListSink(Sink):
+    """
+    >>> s = ListSink()
+    >>> with recording(s):
+    ...     tstr('a') == 'b'
+    False
+    >>> s.log
+    [eq,'a','b']
+    """
+    def __init__(self, log=None):
+        self.log = [] if log is None else log
+
+    def record(self, op, a, b):
+        self.log.append(Instr(op, a, b))
+
+    def record_at(self, op, a, b, site):
+        i = Instr(op, a, b)
+        i.site = site
+        self.log.append(i)
+
+    def record_chars_at(self, op, a, b, start, stop, site):
+        for i in range(start, stop):
+            self.record_at(op, a[i], b[i], site)
+
+    def mark(self):
+        return len(self.log)
+
+    def rollback(self, mark):
+        del self.log[mark:]
+
+    def __iter__(self):
+        return iter(self.log)
+
+    def __len__(self):
+        return len(self.log)
+
+class _ComparisonsSink(ListSink):
+    # looks the list up on every call, so rebinding Comparisons still works
+    def __init__(self):
+        pass
+
+    @property
+    def log(self):
+        return Comparisons
+
+    def record(self, op, a, b):
+        Comparisons.append(Instr(op, a, b))
+
+class RingSink(ListSink):
+    """
+    Keeps only the last maxlen comparisons.
+    >>> s = RingSink(2)
+    >>> with recording(s):
+    ...     tstr('abc') == 'abd'
+    False
+    >>> list(s)
+    [eq,'b','b', eq,'c','d']
+
+    Positions shift as old entries fall out of the ring, so it can not
+    be marked.
+    >>> s.mark()
+    Traceback (most recent call last):
+    ...
+    taintedstr.RollbackError: a RingSink has no stable positions
+    """
+    def __init__(self, maxlen):
+        super().__init__(collections.deque(maxlen=maxlen))
+
+    def mark(self):
+        raise RollbackError('a RingSink has no stable positions')
+
+    def rollback(self, mark):
+        raise RollbackError('a RingSink has no stable positions')
+
+class CallbackSink(Sink):
+    """
+    Streams each comparison to a consumer instead of keeping it.
+    >>> seen = []
+    >>> with recording(CallbackSink(lambda i: seen.append(i.op))):
+    ...     'b' in tstr('abc')
+    True
+    >>> seen
+    [<Op.IN: 6>]
+
+    What was handed on can not be taken back.
+    >>> with recording(CallbackSink(seen.append)):
+    ...     checkpoint()
+    Traceback (most recent call last):
+    ...
+    taintedstr.RollbackError: a CallbackSink can not roll back
+    """
+    def __init__(self, fn):
+        self.fn = fn
+
+    def record(self, op, a, b):
+        self.fn(Instr(op, a, b))
+
+class NullSink(Sink):
+    """
+    >>> with recording(NullSink()):
+    ...     tstr('a') == 'a'
+    True
+    """
+    def record(self, op, a, b):
+        pass
+
+    def record_chars(self, op, a, b, start, stop):
+        pass
+
+    def mark(self):
+        return 0
+
+    def rollback(self, mark):
+        pass
+
+# SpillSink operands are [text, taint runs, cursor]; the runs are the
+# (length, origin, step) triples of the map, not its entries
+def _operand(v):
+    if type(v) is not tstr:
+        return [str(v), None, None]
+    t = v._tmap
+    if type(t) is not RunTaint:
+        t = RunTaint.from_list(t)
+    return [str(v), t.runs(), getattr(v, '_tcursor', None)]
+
+def _from_operand(v):
+    value, runs, cursor = v
+    if runs is None:
+        return value
+    m = RunTaint([], [], [])
+    for run in runs:
+        m._push(*run)
+    t = tstr(value, _compact(m))
+    if cursor is not None:
+        t._tcursor = cursor
+    return t
+
+class SpillSink(Sink):
+    """
+    Writes the comparisons to a file as json lines, batch_size at a time.
+    >>> import tempfile, os
+    >>> fd, path = tempfile.mkstemp()
+    >>> with SpillSink(path, batch_size=2) as s, recording(s):
+    ...     tstr('abc') == 'abd'
+    False
+    >>> [str(i) for i in SpillSink.load(path)]
+    ["'a' = 'a'", "'b' = 'b'", "'c' != 'd'"]
+
+    The taint is written as runs, not one entry per character.
+    >>> x = tstr('abcdef' * 100)
+    >>> with SpillSink(path) as s, recording(s):
+    ...     _ = '-' in x[3:] + x[:2]
+    >>> json.loads(open(path).read())[1][1]
+    [[597, 3, 1], [2, 0, 1]]
+    >>> next(SpillSink.load(path)).opA._taint[596:]
+    [599, 0, 1]
+
+    A mark flushes the batch and keeps the file position, which rollback
+    truncates the file back to.
+    >>> with SpillSink(path, batch_size=2) as s, recording(s):
+    ...     tstr('a') == 'a'
+    ...     mark = checkpoint()
+    ...     tstr('b') == 'c'
+    ...     rollback(mark)
+    True
+    False
+    >>> [str(i) for i in SpillSink.load(path)]
+    ["'a' = 'a'"]
+    >>> os.close(fd); os.remove(path)
+    """
+    def __init__(self, path, batch_size=1024):
+        self.path = path
+        self.batch_size = batch_size
+        self._batch = []
+        self._f = open(path, 'w')
+
+    def record(self, op, a, b):
+        self._batch.append(json.dumps([op.name, _operand(a), _operand(b)]))
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._batch:
+            self._f.write('\n'.join(self._batch) + '\n')
+            self._batch = []
+        self._f.flush()
+
+    def mark(self):
+        self.flush()
+        return self._f.tell()
+
+    def rollback(self, mark):
+        self._batch = []
+        self._f.seek(mark)
+        self._f.truncate()
+
+    def close(self):
+        self.flush()
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            for line in f:
+                op, a, b = json.loads(line)
+                yield Instr(Op[op], _from_operand(a), _from_operand(b))
+
+LOG_MAGIC = b'TSTRLOG1'
+_SITE_DEF = 0xff
+_TEXT_DEF = 0xfe
+# operands at least TEXT_INTERN_MIN and at most TEXT_INTERN_MAX long are
+# written once and then referred to by id
+TEXT_INTERN_MIN = 16
+TEXT_INTERN_MAX = 4096
+# the number of strings a BinarySink keeps ids for by default
+TEXT_INTERN_SIZE = 1024
+
+def _put_text(buf, text):
+    data = text.encode('utf-8', 'surrogatepass')
+    _put_uint(buf, len(data))
+    buf += data
+
+def _get_text(buf, pos):
+    n, pos = _get_uint(buf, pos)
+    return bytes(buf[pos:pos + n]).decode('utf-8', 'surrogatepass'), pos + n
+
+class BinarySink(Sink):
+    """
+    Appends the comparisons to a file in a compact binary format. Each
+    record is its length in four bytes, the op, a flags byte, and the
+    operands as utf-8 with their taint map run encoded (encode_taint).
+    Longer operand strings and call sites are written once, as definition
+    records before their first use, and referred to by id after that.
+    Only the intern_size most recently used strings keep their ids; the
+    id of the least recently used one goes to the next new string, and
+    an evicted string is defined again when it comes back. load() reads
+    the records back lazily.
+    >>> import tempfile, os
+    >>> fd, path = tempfile.mkstemp()
+    >>> with BinarySink(path) as s, recording(s):
+    ...     tstr('abc') == 'abd'
+    ...     tstr('ab')[2:] == 'c'
+    False
+    False
+    >>> log = list(BinarySink.load(path))
+    >>> [str(i) for i in log]
+    ["'a' = 'a'", "'b' = 'b'", "'c' != 'd'", "'' != 'c'"]
+    >>> log[2].opA.x(), log[3].opA._tcursor
+    (2, 2)
+
+    Rolling back truncates the file, and forgets the strings and call
+    sites defined after the mark.
+    >>> with BinarySink(path) as s, recording(s):
+    ...     mark = checkpoint()
+    ...     'x' in tstr('a long operand string')
+    ...     rollback(mark)
+    ...     'y' in tstr('a long operand string')
+    False
+    False
+    >>> [str(i) for i in BinarySink.load(path)][4:]
+    ["'a long operand string' not in 'y'"]
+
+    >>> with BinarySink(path, intern_size=1) as s, recording(s):
+    ...     for v in ['the first long string', 'the second long string'] * 2:
+    ...         _ = 'x' in tstr(v)
+    >>> [str(i.opA) for i in BinarySink.load(path)][5:]
+    ['the first long string', 'the second long string', 'the first long string', 'the second long string']
+    >>> len(s._texts)
+    1
+    >>> os.close(fd); os.remove(path)
+    """
+    def __init__(self, path, intern_size=TEXT_INTERN_SIZE):
+        self.path = path
+        self.intern_size = intern_size
+        self._f = open(path, 'ab')
+        if self._f.tell() == 0:
+            self._f.write(LOG_MAGIC)
+        # call sites and strings defined in the file so far, the strings
+        # least recently used first, and the ids given back by rollback
+        self._sites = set()
+        self._texts = collections.OrderedDict()
+        self._free = []
+        # (is_site, key) of each definition since the first mark
+        self._defs = None
+
+    def _write(self, buf):
+        self._f.write(struct.pack('<I', len(buf)) + buf)
+
+    def _put_operand(self, buf, v):
+        is_tstr = type(v) is tstr
+        text = str.__str__(v) if is_tstr else str(v)
+        if not TEXT_INTERN_MIN <= len(text) <= TEXT_INTERN_MAX:
+            # an inline string, tagged with its length
+            data = text.encode('utf-8', 'surrogatepass')
+            _put_uint(buf, len(data) << 1)
+            buf += data
+        else:
+            i = self._texts.get(text)
+            if i is None:
+                i = self._define_text(text)
+            else:
+                self._texts.move_to_end(text)
+            _put_uint(buf, i << 1 | 1)
+        if is_tstr:
+            encode_taint(v._tmap, buf)
+
+    def record(self, op, a, b):
+        self.record_at(op, a, b, -1)
+
+    def record_at(self, op, a, b, site):
+        flags = (type(a) is tstr) | (type(b) is tstr) << 1
+        cursors = []
+        for bit, v in ((4, a), (8, b)):
+            if type(v) is tstr and not v and hasattr(v, '_tcursor'):
+                flags |= bit
+                cursors.append(v._tcursor)
+        if site >= 0:
+            self._define(site)
+            flags |= 16
+        buf = bytearray((op.value, flags))
+        self._put_operand(buf, a)
+        self._put_operand(buf, b)
+        for c in cursors:
+            _put_int(buf, c)
+        if site >= 0:
+            _put_uint(buf, site)
+        self._write(buf)
+
+    def record_chars(self, op, a, b, start, stop):
+        self.record_chars_at(op, a, b, start, stop, -1)
+
+    def record_chars_at(self, op, a, b, start, stop, site):
+        # the taint of one character is a single run
+        sa, sb = str.__str__(a), str(b)
+        tb = b._tmap if type(b) is tstr else None
+        flags = 1 | (tb is not None) << 1 | (site >= 0) << 4
+        if site >= 0:
+            self._define(site)
+        for i in range(start, stop):
+            buf = bytearray((op.value, flags))
+            for c, t in ((sa[i], a._tmap), (sb[i], tb)):
+                data = c.encode('utf-8', 'surrogatepass')
+                _put_uint(buf, len(data) << 1)
+                buf += data
+                if t is not None:
+                    buf += b'\x01\x01'
+                    _put_int(buf, t[i])
+                    buf.append(0)
+            if site >= 0:
+                _put_uint(buf, site)
+            self._write(buf)
+
+    def _define_text(self, text):
+        texts = self._texts
+        if len(texts) >= self.intern_size:
+            _, i = texts.popitem(last=False)
+        elif self._free:
+            i = self._free.pop()
+        else:
+            i = len(texts)
+        texts[text] = i
+        if self._defs is not None:
+            self._defs.append((False, text))
+        d = bytearray((_TEXT_DEF,))
+        _put_uint(d, i)
+        _put_text(d, text)
+        self._write(d)
+        return i
+
+    def _define(self, site):
+        if site in self._sites:
+            return
+        self._sites.add(site)
+        if self._defs is not None:
+            self._defs.append((True, site))
+        file, line, fn = call_sites[site]
+        buf = bytearray((_SITE_DEF,))
+        _put_uint(buf, site)
+        _put_text(buf, file)
+        _put_uint(buf, line)
+        _put_text(buf, fn)
+        self._write(buf)
+
+    def flush(self):
+        self._f.flush()
+
+    def mark(self):
+        self._f.flush()
+        if self._defs is None:
+            self._defs = []
+        return (self._f.tell(), len(self._defs))
+
+    def rollback(self, mark):
+        pos, ndefs = mark
+        defs = self._defs
+        while len(defs) > ndefs:
+            is_site, key = defs.pop()
+            if is_site:
+                self._sites.discard(key)
+                continue
+            # the definition is cut off, so the id is free again
+            i = self._texts.pop(key, None)
+            if i is not None:
+                self._free.append(i)
+        self._f.seek(pos)
+        self._f.truncate()
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def _get_operand(buf, pos, is_tstr, texts):
+        tag, pos = _get_uint(buf, pos)
+        if tag & 1:
+            text = texts[tag >> 1]
+        else:
+            text = bytes(buf[pos:pos + (tag >> 1)]).decode('utf-8', 'surrogatepass')
+            pos += tag >> 1
+        if not is_tstr:
+            return text, pos
+        t, pos = decode_taint(buf, pos)
+        return _restore(tstr, text, t), pos
+
+    @staticmethod
+    def load(path):
+        """
+        Yields the Instrs in the file at path as they are read. A record
+        cut short at the end of the file (by a writer that did not get to
+        finish) is left out.
+        """
+        sites = {}
+        texts = {}
+        with open(path, 'rb') as f:
+            if f.read(len(LOG_MAGIC)) != LOG_MAGIC:
+                raise ValueError('%s is not a comparison log' % path)
+            while True:
+                head = f.read(4)
+                if len(head) < 4:
+                    return
+                n, = struct.unpack('<I', head)
+                buf = f.read(n)
+                if len(buf) < n:
+                    return
+                if buf[0] == _SITE_DEF:
+                    i, pos = _get_uint(buf, 1)
+                    file, pos = _get_text(buf, pos)
+                    line, pos = _get_uint(buf, pos)
+                    fn, pos = _get_text(buf, pos)
+                    sites[i] = call_sites.intern((file, line, fn))
+                    continue
+                if buf[0] == _TEXT_DEF:
+                    i, pos = _get_uint(buf, 1)
+                    texts[i], pos = _get_text(buf, pos)
+                    continue
+                op, flags = _OPS[buf[0]], buf[1]
+                a, pos = BinarySink._get_operand(buf, 2, flags & 1, texts)
+                b, pos = BinarySink._get_operand(buf, pos, flags & 2, texts)
+                for bit, v in ((4, a), (8, b)):
+                    if flags & bit:
+                        v._tcursor, pos = _get_int(buf, pos)
+                instr = Instr(op, a, b)
+                if flags & 16:
+                    i, pos = _get_uint(buf, pos)
+                    instr.site = sites.get(i, -1)
+                yield instr
+
+_OPS = list(Op)
+NO_CURSOR = -2**63
+
+class RecordStore(Sink):
+    """
+    Keeps the comparisons in columns (one typed array per field) rather
+    than as Instr objects. Operand strings are interned, and so are the
+    taint maps (encoded with encode_taint) of operands whose taint is not
+    just a contiguous range from the first character's. Instr objects
+    are built on demand when the store is indexed or iterated.
+    >>> s = RecordStore()
+    >>> with recording(s):
+    ...     tstr('abc') == 'abd'
+    False
+    >>> len(s), s[2]
+    (3, eq,'c','d')
+    >>> s[2].opA.x()
+    2
+    >>> s.columns()['a_taint'].tolist()
+    [0, 1, 2]
+    >>> s.strings
+    ['a', 'b', 'c', 'd']
+
+    Operands keep the taint they were recorded with.
+    >>> x = tstr('abcdef')
+    >>> s = RecordStore()
+    >>> with recording(s):
+    ...     _ = '-' in (x[3:] + '-' + x[:2])
+    ...     _ = ('-' + x).split('c')
+    >>> s[0].opA._taint, s[1].opA._taint
+    ([3, 4, 5, -1, 0, 1], [-1, 0, 1, 2, 3, 4, 5])
+    >>> len(s.maps)
+    2
+    """
+    COLUMNS = ('op', 'flags', 'a_id', 'a_taint', 'a_map', 'b_id', 'b_taint',
+            'b_map', 'cursor', 'site')
+
+    def __init__(self):
+        self.strings = []
+        self._ids = {}
+        self.maps = []
+        self._map_ids = {}
+        self.clear()
+
+    def clear(self):
+        self.op = array.array('b')
+        self.flags = array.array('b')
+        self.a_id = array.array('i')
+        self.a_taint = array.array('q')
+        self.a_map = array.array('i')
+        self.b_id = array.array('i')
+        self.b_taint = array.array('q')
+        self.b_map = array.array('i')
+        self.cursor = array.array('q')
+        self.site = array.array('i')
+
+    def __getstate__(self):
+        # the intern table is rebuilt from strings on load, and the call
+        # sites travel along, since ids differ between processes
+        state = dict(self.__dict__)
+        del state['_ids'], state['_map_ids']
+        state['sites'] = {i: call_sites[i] for i in set(self.site) if i >= 0}
+        return state
+
+    def __setstate__(self, state):
+        sites = state.pop('sites')
+        self.__dict__.update(state)
+        self._ids = {s: i for i, s in enumerate(self.strings)}
+        self._map_ids = {m: i for i, m in enumerate(self.maps)}
+        ids = {i: call_sites.intern(site) for i, site in sites.items()}
+        if any(i != j for i, j in ids.items()):
+            self.site = array.array('i', [ids.get(i, -1) for i in self.site])
+
+    def intern(self, s):
+        s = str(s)
+        i = self._ids.get(s)
+        if i is None:
+            i = self._ids[s] = len(self.strings)
+            self.strings.append(s)
+        return i
+
+    def intern_map(self, v):
+        # the id of the encoded map of tstr v, or -1 when the first
+        # character's taint is enough to rebuild it
+        t = v._tmap
+        if len(t) < 2 or (type(t) is RunTaint and t.nruns() == 1
+                and (t._steps[0] == 1 or t._vals[0] < 0)):
+            return -1
+        m = bytes(encode_taint(t))
+        i = self._map_ids.get(m)
+        if i is None:
+            i = self._map_ids[m] = len(self.maps)
+            self.maps.append(m)
+        return i
+
+    def record(self, op, a, b):
+        self.record_at(op, a, b, -1)
+
+    def record_at(self, op, a, b, site):
+        flags = 0
+        cursor = NO_CURSOR
+        a_taint = b_taint = a_map = b_map = -1
+        if type(a) is tstr:
+            flags |= 1
+            if a:
+                a_taint = a._tmap[0]
+                a_map = self.intern_map(a)
+            else:
+                cursor = getattr(a, '_tcursor', NO_CURSOR)
+        if type(b) is tstr:
+            flags |= 2
+            if b:
+                b_taint = b._tmap[0]
+                b_map = self.intern_map(b)
+            elif cursor == NO_CURSOR:
+                cursor = getattr(b, '_tcursor', NO_CURSOR)
+        self.op.append(op.value)
+        self.flags.append(flags)
+        self.a_id.append(self.intern(a))
+        self.a_taint.append(a_taint)
+        self.a_map.append(a_map)
+        self.b_id.append(self.intern(b))
+        self.b_taint.append(b_taint)
+        self.b_map.append(b_map)
+        self.cursor.append(cursor)
+        self.site.append(site)
+
+    def record_chars(self, op, a, b, start, stop):
+        self.record_chars_at(op, a, b, start, stop, -1)
+
+    def record_chars_at(self, op, a, b, start, stop, site):
+        n = stop - start
+        intern = self.intern
+        self.op.extend(array.array('b', [op.value]) * n)
+        self.flags.extend(array.array('b', [1 | (2 if type(b) is tstr else 0)]) * n)
+        self.a_id.extend([intern(c) for c in str(a)[start:stop]])
+        self.a_taint.extend(a._tmap[start:stop])
+        self.a_map.extend(array.array('i', [-1]) * n)
+        self.b_id.extend([intern(c) for c in str(b)[start:stop]])
+        if type(b) is tstr:
+            self.b_taint.extend(b._tmap[start:stop])
+        else:
+            self.b_taint.extend(array.array('q', [-1]) * n)
+        self.b_map.extend(array.array('i', [-1]) * n)
+        self.cursor.extend(array.array('q', [NO_CURSOR]) * n)
+        self.site.extend(array.array('i', [site]) * n)
+
+    def _operand(self, value, is_tstr, taint, map_id, cursor):
+        if not is_tstr:
+            return value
+        if map_id >= 0:
+            t = _restore(tstr, value, _decode_map(self.maps[map_id]))
+        elif taint >= 0:
+            t = tstr(value, RunTaint.identity(len(value), taint))
+        else:
+            t = tstr(value).untaint()
+        if not value and cursor != NO_CURSOR:
+            t._tcursor = cursor
+        return t
+
+    def __len__(self):
+        return len(self.op)
+
+    def __getitem__(self, i):
+        flags, cursor = self.flags[i], self.cursor[i]
+        a = self._operand(self.strings[self.a_id[i]], flags & 1,
+                self.a_taint[i], self.a_map[i], cursor)
+        b = self._operand(self.strings[self.b_id[i]], flags & 2,
+                self.b_taint[i], self.b_map[i], cursor)
+        instr = Instr(_OPS[self.op[i]], a, b)
+        instr.site = self.site[i]
+        return instr
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def columns(self):
+        # buffers suitable for numpy.frombuffer
+        return {c: memoryview(getattr(self, c)) for c in self.COLUMNS}
+
+    def mark(self):
+        return (len(self), len(self.strings), len(self.maps))
+
+    def rollback(self, mark):
+        """
+        Truncates the columns, and forgets the strings and maps interned
+        since.
+        >>> s = RecordStore()
+        >>> m = s.mark()
+        >>> with recording(s):
+        ...     tstr('ab') == 'xy'
+        False
+        >>> s.rollback(m)
+        >>> len(s), s.strings
+        (0, [])
+        """
+        n, nstrings, nmaps = mark
+        for c in self.COLUMNS:
+            del getattr(self, c)[n:]
+        for v in self.strings[nstrings:]:
+            del self._ids[v]
+        del self.strings[nstrings:]
+        for m in self.maps[nmaps:]:
+            del self._map_ids[m]
+        del self.maps[nmaps:]
+
+    def site_counts(self):
+        "The number of comparisons recorded at each captured call site."
+        return {call_sites[i]: n for i, n in collections.Counter(self.site).items()
+                if i >= 0}
+
+def _matches(op, a, b):
+    # whether the operands matched, whichever way round the test was; an
+    # IN is recorded as (haystack, needle)
+    if op in (Op.EQ, Op.NE):
+        return a == b
+    if op in (Op.IN, Op.NOT_IN):
+        return b in a
+    # a regex records whether it matched in the op
+    return op == Op.RE_MATCH
+
+class PositionIndex(Sink):
+    """
+    Indexes the comparisons by input position as they are recorded. For
+    each position it keeps the values it was compared against, in the
+    order they were first seen, with how often they matched and did not.
+    Comparisons of an empty string at the end of the input are kept by
+    their cursor in eof.
+    >>> idx = PositionIndex()
+    >>> my_str = tstr('ab')
+    >>> with recording(idx):
+    ...     _ = my_str[0] == 'x'
+    ...     _ = my_str[0] == 'a'
+    ...     _ = my_str[0] == 'a'
+    ...     _ = my_str[2:] == ')'
+    >>> idx[0]
+    {'x': [0, 1], 'a': [2, 0]}
+    >>> idx.eof
+    {2: {')': [0, 1]}}
+    >>> idx.get(1, 'b'), 0 in idx, 1 in idx
+    ((0, 0), True, False)
+
+    Containment is counted as a hit when the needle was found.
+    >>> idx = PositionIndex()
+    >>> with recording(idx):
+    ...     _ = 'b' in tstr('abc')
+    ...     _ = 'x' in tstr('abc')
+    ...     _ = tstr('abc').split('b')
+    >>> idx[0]
+    {'b': [2, 0], 'x': [0, 1]}
+
+    A regex match counts as a hit even when flags or the context outside
+    the span made it one.
+    >>> import taintedre
+    >>> ri = PositionIndex()
+    >>> with recording(ri):
+    ...     _ = taintedre.compile('a b', re.X).match(tstr('ab'))
+    ...     _ = taintedre.search(r'(?<=x)a', tstr('xa'))
+    >>> ri[0], ri[1]
+    ({'a b': [1, 0]}, {'(?<=x)a': [1, 0]})
+
+    Once marked, the index journals what it counts, and rollback takes
+    the counts since the mark back out.
+    >>> mark = idx.mark()
+    >>> with recording(idx):
+    ...     _ = 'b' in tstr('abc')
+    ...     _ = tstr('abc') == 'y'
+    >>> idx.rollback(mark)
+    >>> idx[0]
+    {'b': [2, 0], 'x': [0, 1]}
+    """
+    def __init__(self):
+        self.positions = {}
+        self.eof = {}
+        # comparisons without taint or cursor
+        self.untainted = 0
+        # (table, pos, value, hit) for each count since the first mark
+        self._journal = None
+
+    @staticmethod
+    def _counts(table, pos, value):
+        values = table.get(pos)
+        if values is None:
+            values = table[pos] = {}
+        c = values.get(value)
+        if c is None:
+            c = values[value] = [0, 0]
+        return c
+
+    def _add(self, table, pos, value, hit):
+        self._counts(table, pos, value)[0 if hit else 1] += 1
+        if self._journal is not None:
+            self._journal.append((table, pos, value, hit))
+
+    def _add_untainted(self):
+        self.untainted += 1
+        if self._journal is not None:
+            self._journal.append(None)
+
+    def mark(self):
+        if self._journal is None:
+            self._journal = []
+        return len(self._journal)
+
+    def rollback(self, mark):
+        journal = self._journal
+        while len(journal) > mark:
+            e = journal.pop()
+            if e is None:
+                self.untainted -= 1
+                continue
+            # entries first seen since the mark are the last in their dicts
+            table, pos, value, hit = e
+            values = table[pos]
+            c = values[value]
+            c[0 if hit else 1] -= 1
+            if c == [0, 0]:
+                del values[value]
+                if not values:
+                    del table[pos]
+
+    def record(self, op, a, b):
+        hit = _matches(op, str(a), str(b))
+        if not _is_tainted(a, None) and _is_tainted(b, None):
+            a, b = b, a
+        if _is_tainted(a, None):
+            self._add(self.positions, a._tmap.first_tainted(), str(b), hit)
+            return
+        for v, w in ((a, b), (b, a)):
+            if type(v) is tstr and not v and hasattr(v, '_tcursor'):
+                self._add(self.eof, v._tcursor, str(w), hit)
+                return
+        self._add_untainted()
+
+    def record_chars(self, op, a, b, start, stop):
+        sa, sb = str.__str__(a), str(b)
+        tb = b._tmap if type(b) is tstr else None
+        for i in range(start, stop):
+            x, y = sa[i], sb[i]
+            t = a._tmap[i]
+            if t < 0 and tb is not None and tb[i] >= 0:
+                t, y = tb[i], x
+            if t < 0:
+                self._add_untainted()
+            else:
+                self._add(self.positions, t, y, x == sb[i])
+
+    @classmethod
+    def from_log(cls, log):
+        "Indexes an existing log of Instrs, such as Comparisons."
+        idx = cls()
+        for i in log:
+            idx.record(i.op, i.opA, i.opB)
+        return idx
+
+    def __getitem__(self, pos):
+        return self.positions[pos]
+
+    def __contains__(self, pos):
+        return pos in self.positions
+
+    def __len__(self):
+        return len(self.positions)
+
+    def get(self, pos, value):
+        "(hits, misses) of comparisons of pos against value."
+        c = self.positions.get(pos, {}).get(value)
+        return tuple(c) if c else (0, 0)
+
+    def snapshot(self):
+        "A copy that later comparisons do not change."
+        idx = PositionIndex()
+        idx.merge(self)
+        return idx
+
+    def merge(self, other):
+        """
+        Adds the counts of other to this index. Values new to a position
+        come after the ones already there. A rollback does not undo a
+        merge.
+        >>> a, b = PositionIndex(), PositionIndex()
+        >>> with recording(a): _ = tstr('x') == 'y'
+        >>> with recording(b): _ = tstr('x') == 'x'
+        >>> a.merge(b)[0]
+        {'y': [0, 1], 'x': [1, 0]}
+        """
+        for mine, theirs in ((self.positions, other.positions), (self.eof, other.eof)):
+            for pos, values in theirs.items():
+                for value, (hits, misses) in values.items():
+                    c = self._counts(mine, pos, value)
+                    c[0] += hits
+                    c[1] += misses
+        self.untainted += other.untainted
+        return self
+
+# The process wide sink, used outside of any tracing session.
+_sink = _ComparisonsSink()
+
+def set_sink(sink):
+    # returns the sink that was active before
+    global _sink
+    old, _sink = _sink, sink
+    return old
+
+# How derived strings refer to the string they were made from: 'full'
+# keeps a reference to the parent, 'weak' a weak reference, and 'none'
+# drops the parent chain so that slices do not keep their inputs alive.
+PROVENANCE_MODES = ('none', 'weak', 'full')
+_provenance = 'full'
+
+def set_provenance(mode):
+    # returns the mode that was active before
+    global _provenance
+    _check_provenance(mode)
+    old, _provenance = _provenance, mode
+    return old
+
+def _check_provenance(mode):
+    if mode not in PROVENANCE_MODES:
+        raise ValueError('Unknown provenance mode %r' % mode)
+
+def _provenance_mode():
+    s = _session.get()
+    return s.provenance if s and s.provenance else _provenance
+
+# one character tstrs shared per (char, taint) when provenance is 'none'
+CHAR_CACHE_SIZE = 4096
+_chars = {}
+
+# Recording policies decide, before the sink allocates anything for it,
+# whether a comparison is recorded. admit() gets the operands, and i when
+# the comparison is between a[i] and b[i].
+class RecordPolicy:
+    def admit(self, op, a, b, i=None):
+        return True
+
+def _is_tainted(v, i):
+    if type(v) is not tstr:
+        return False
+    return (v._tmap[i] if i is not None else v._tmap.first_tainted()) >= 0
+
+def _operand_key(v, i):
+    # a tainted operand stands for its input positions, anything else for
+    # its value
+    if type(v) is tstr:
+        if i is not None:
+            t = v._tmap[i]
+            return (t,) if t >= 0 else str.__getitem__(v, i)
+        s = v._tmap.summary()
+        if s.first_idx >= 0:
+            return (s.first_idx, s.first, len(v))
+        return str.__str__(v)
+    if i is not None:
+        return v[i]
+    return v if isinstance(v, str) else repr(v)
+
+# source files whose frames are not call sites of comparisons
+_INTERNAL = {__file__}
+
+class SiteTable:
+    """
+    Interns call sites, (file, line, function) triples, as small ints.
+    >>> t = SiteTable()
+    >>> t.intern(('a.py', 3, 'f')), t.intern(('a.py', 4, 'f')), t.intern(('a.py', 3, 'f'))
+    (0, 1, 0)
+    >>> t[1]
+    ('a.py', 4, 'f')
+    """
+    def __init__(self):
+        self.sites = []
+        self._ids = {}
+
+    def intern(self, site):
+        i = self._ids.get(site)
+        if i is None:
+            i = self._ids[site] = len(self.sites)
+            self.sites.append(site)
+        return i
+
+    def __getitem__(self, i):
+        return self.sites[i]
+
+    def __len__(self):
+        return len(self.sites)
+
+# the call sites of the process, which Instr.site and RecordStore refer to
+call_sites = SiteTable()
+
+def _site_id(depth=0):
+    # the innermost frame outside the tainted modules, or depth frames
+    # further out
+    f = sys._getframe(1)
+    while f is not None and f.f_code.co_filename in _INTERNAL:
+        f = f.f_back
+    for _ in range(depth):
+        if f is None or f.f_back is None:
+            break
+        f = f.f_back
+    if f is None:
+        return -1
+    code = f.f_code
+    return call_sites.intern((code.co_filename, f.f_lineno, code.co_name))
+
+class TaintedOnly(RecordPolicy):
+    """
+    Records only comparisons where an operand carries taint.
+    >>> with taint_session(policy=TaintedOnly()) as s:
+    ...     tstr('ab').untaint() == 'ab'
+    ...     tstr('ab') == 'ab'
+    True
+    True
+    >>> len(s.sink), s.dropped
+    (2, Counter({<Op.EQ: 2>: 2}))
+    """
+    def admit(self, op, a, b, i=None):
+        return _is_tainted(a, i) or _is_tainted(b, i)
+
+class FirstN(RecordPolicy):
+    """
+    Records the first n comparisons of the same input positions against
+    the same value.
+    >>> my_str = tstr('aaa')
+    >>> with taint_session(policy=FirstN(2)) as s:
+    ...     for _ in range(5): _ = my_str[0] == 'b'
+    ...     _ = my_str[1] == 'b'
+    >>> len(s.sink)
+    3
+    """
+    def __init__(self, n):
+        self.n = n
+        self.seen = collections.Counter()
+
+    def _key(self, op, a, b, i):
+        return (op, _operand_key(a, i), _operand_key(b, i))
+
+    def admit(self, op, a, b, i=None):
+        key = self._key(op, a, b, i)
+        c = self.seen[key]
+        if c >= self.n:
+            return False
+        self.seen[key] = c + 1
+        return True
+
+class OncePerSite(FirstN):
+    """
+    Records a comparison once for each call site that makes it.
+    >>> my_str = tstr('ab')
+    >>> with taint_session(policy=OncePerSite()) as s:
+    ...     for _ in range(3):
+    ...         _ = my_str == 'x'
+    ...         _ = my_str == 'x'
+    >>> len(s.sink)
+    2
+    """
+    def __init__(self, n=1):
+        super().__init__(n)
+
+    def _key(self, op, a, b, i):
+        return (_site_id(), op, _operand_key(a, i), _operand_key(b, i))
+
+class Sample(RecordPolicy):
+    """
+    Records each comparison with the given probability. The seed makes
+    the choice reproducible.
+    >>> def sampled():
+    ...     with taint_session(policy=Sample(0.5, seed=1)) as s:
+    ...         tstr('a' * 100) == 'a' * 100
+    ...     return len(s.sink)
+    >>> sampled() == sampled(), 20 < sampled() < 80
+    (True, True)
+    """
+    def __init__(self, rate, seed=0):
+        self.rate = rate
+        self._random = random.Random(seed).random
+
+    def admit(self, op, a, b, i=None):
+        return self._random() < self.rate
+
+class Session:
+    """
+    A tracing session records into its own sink and counts the
+    comparisons made while it is active. Sessions live in a context
+    variable, so every thread and asyncio task sees only its own.
+    >>> import threading
+    >>> def trace(v, out):
+    ...     with taint_session() as s:
+    ...         tstr(v) == 'abc'
+    ...         out.append(s)
+    >>> out = []
+    >>> ts = [threading.Thread(target=trace, args=(v, out)) for v in ['abc', 'x']]
+    >>> for t in ts: t.start()
+    >>> for t in ts: t.join()
+    >>> sorted(len(s.sink) for s in out)
+    [1, 3]
+    >>> with taint_session() as outer:
+    ...     with taint_session() as inner:
+    ...         'a' in tstr('abc')
+    ...     tstr('ab') == 'ab'
+    True
+    True
+    >>> outer.counts, inner.counts
+    (Counter({<Op.EQ: 2>: 2}), Counter({<Op.IN: 6>: 1}))
+
+    A session can also take a recording policy, or a list of them that
+    all have to admit a comparison for it to be recorded. The comparisons
+    left out are counted in dropped.
+    >>> my_str = tstr('a')
+    >>> with taint_session(policy=[TaintedOnly(), FirstN(1)]) as s:
+    ...     for _ in range(3): _ = my_str == 'b'
+    ...     _ = tstr('b').untaint() == 'b'
+    >>> s.sink.log, s.dropped
+    ([eq,'a','b'], Counter({<Op.EQ: 2>: 3}))
+
+    With sites set to a depth, each record carries the id of its call
+    site in call_sites: the innermost frame outside the tainted modules,
+    or that many frames further out. site_counts aggregates them.
+    >>> def parse(v):
+    ...     return v == 'ab'
+    >>> with taint_session(sites=0) as s:
+    ...     _ = parse(tstr('ab'))
+    >>> [call_sites[i][2] for i in s.site_counts], [i.site for i in s.sink.log] == [s.sink.log[0].site] * 2
+    (['parse'], True)
+    """
+    def __init__(self, sink=None, provenance=None, policy=None, sites=None):
+        if provenance is not None:
+            _check_provenance(provenance)
+        self.sink = ListSink() if sink is None else sink
+        self.provenance = provenance
+        if policy is None:
+            policy = ()
+        elif isinstance(policy, RecordPolicy):
+            policy = (policy,)
+        self.policies = tuple(policy)
+        self.sites = sites
+        self.counts = collections.Counter()
+        self.dropped = collections.Counter()
+        self.site_counts = collections.Counter()
+
+    def record(self, op, a, b):
+        self.counts[op] += 1
+        if self.policies:
+            for p in self.policies:
+                if not p.admit(op, a, b):
+                    self.dropped[op] += 1
+                    return
+        if self.sites is None:
+            self.sink.record(op, a, b)
+        else:
+            site = _site_id(self.sites)
+            self.site_counts[site] += 1
+            self.sink.record_at(op, a, b, site)
+
+    def record_chars(self, op, a, b, start, stop):
+        self.counts[op] += stop - start
+        if not self.policies:
+            self._record_chars(op, a, b, start, stop)
+            return
+        # hand the admitted stretches on in bulk
+        first = None
+        for i in range(start, stop):
+            if all(p.admit(op, a, b, i) for p in self.policies):
+                if first is None:
+                    first = i
+                continue
+            self.dropped[op] += 1
+            if first is not None:
+                self._record_chars(op, a, b, first, i)
+                first = None
+        if first is not None:
+            self._record_chars(op, a, b, first, stop)
+
+    def mark(self):
+        return self.sink.mark()
+
+    def rollback(self, mark):
+        self.sink.rollback(mark)
+
+    def _record_chars(self, op, a, b, start, stop):
+        if self.sites is None:
+            self.sink.record_chars(op, a, b, start, stop)
+        else:
+            site = _site_id(self.sites)
+            self.site_counts[site] += stop - start
+            self.sink.record_chars_at(op, a, b, start, stop, site)
+
+_session = contextvars.ContextVar('taintedstr_session', default=None)
+
+@contextlib.contextmanager
+def taint_session(sink=None, provenance=None, policy=None, sites=None):
+    s = Session(sink, provenance, policy, sites)
+    token = _session.set(s)
+    try:
+        yield s
+    finally:
+        _session.reset(token)
+
+@contextlib.contextmanager
+def recording(sink):
+    with taint_session(sink):
+        yield sink
+
+def checkpoint():
+    """
+    Marks the log of the active sink. rollback(mark) truncates it back
+    to the mark, which lets a fuzzing loop reuse one log across runs.
+    >>> tpl = InputTemplate()
+    >>> with recording(ListSink()) as log:
+    ...     _ = tstr('x') == 'y'
+    ...     mark = checkpoint()
+    ...     for v in ['ab', 'cd']:
+    ...         _ = tpl(v) == 'cd'
+    ...         len(log)
+    ...         rollback(mark)
+    2
+    3
+    >>> log.log
+    [eq,'x','y']
+    """
+    return (_session.get() or _sink).mark()
+
+def rollback(mark):
+    (_session.get() or _sink).rollback(mark)
+
+def _record(op, a, b):
+    (_session.get() or _sink).record(op, a, b)
+
+def _record_chars(op, a, b, start, stop):
+    (_session.get() or _sink).record_chars(op, a, b, start, stop)
+
+def _mismatch(a, b, k):
+    # index of the first differing character in the first k, or k
+    if a[:k] == b[:k]:
+        return k
+    for i, (x, y) in enumerate(zip(a, b)):
+        if x != y:
+            return i
+
 class tstr_iterator():
+    # walks the characters and the taint map side by side instead of
+    # indexing the tstr for each character
     def __init__(self, tstr):
         self._tstr = tstr
-        self._str_idx = 0
+        self._chars = iter(str.__str__(tstr))
+        self._taints = iter(tstr._tmap)
+
+    def __iter__(self):
+        return self
 
     def __next__(self):
-        if self._str_idx == len(self._tstr): raise StopIteration
-        # calls tstr getitem should be tstr
-        c = self._tstr[self._str_idx]
-        assert type(c) is tstr
-        self._str_idx += 1
-        return c
+        return self._tstr._char(next(self._chars), next(self._taints))
 
 def substrings(s, l):
     for i in range(len(s)-(l-1)):
@@ -105,21 +1918,102 @@ class tstr(str):
         # tain map contains non-overlapping portions that are mapped to the
         # original string
         self.parent = parent
-        l = len(self)
         if taint:
             # assert that the provided tmap carries only
             # as many entries as len.
             assert len(taint) == len(self)
-            self._taint = taint
+            self._tmap = taint_map(taint)
         else:
-            self._taint = list(range(0, len(self)))
+            self._tmap = RunTaint.identity(len(self))
+            if taint is None and not len(self):
+                # the EOF of an empty input is at 0
+                self._tcursor = 0
+
+    def __reduce__(self):
+        """
+        Pickles the string with its run encoded taint map, and without
+        the parent it was derived from.
+        >>> import pickle
+        >>> v = pickle.loads(pickle.dumps(tstr('abcdef')[2:4]))
+        >>> v, v._taint, v.parent
+        ('cd', [2, 3], None)
+        >>> pickle.loads(pickle.dumps(tstr('ab')[2:]))._tcursor
+        2
+        """
+        return (_restore, (tstr, str.__str__(self), self._tmap,
+            getattr(self, '_tcursor', None)))
+
+    @property
+    def parent(self):
+        """
+        >>> my_str = tstr('abc')
+        >>> old = set_provenance('weak')
+        >>> v = my_str[1:]
+        >>> v.parent is my_str
+        True
+        >>> del my_str
+        >>> v.parent is None
+        True
+        >>> _ = set_provenance('none')
+        >>> v[0].parent is None
+        True
+        >>> _ = set_provenance(old)
+        """
+        p = self._parent
+        return p() if type(p) is weakref.ref else p
+
+    @parent.setter
+    def parent(self, parent):
+        mode = _provenance_mode()
+        if parent is None or mode == 'none':
+            self._parent = None
+        elif mode == 'weak':
+            try:
+                self._parent = weakref.ref(parent)
+            except TypeError:
+                # bytes subclasses (tbytes) can not be weakly referenced
+                self._parent = None
+        else:
+            self._parent = parent
+
+    # The per character taint as a read only list, materialized from the
+    # taint map (the last few are reused); assign to it to replace the
+    # taint.
+    @property
+    def _taint(self):
+        """
+        >>> my_str = tstr('abcdefghijkl', taint=list(range(4,16)))
+        >>> v = my_str[1:5] + my_str[8:]
+        >>> v._taint
+        [5, 6, 7, 8, 12, 13, 14, 15]
+        >>> v._tmap.runs()
+        [(4, 5, 1), (4, 12, 1)]
+        >>> v._taint is v._taint
+        True
+        """
+        return self._tmap.aslist()
+
+    @_taint.setter
+    def _taint(self, taint):
+        self._unshared()
+        assert len(taint) == len(self)
+        self._tmap = taint_map(taint)
 
     def untaint(self):
-        self._taint =  [-1] * len(self)
+        self._unshared()
+        self._tmap = RunTaint.constant(len(self))
         return self
 
+    # set on the one character flyweights handed out by _char
+    _shared = False
+
+    def _unshared(self):
+        if self._shared:
+            raise TaintException('a shared one character tstr can not be '
+                    'changed; change a copy (c[:]) instead')
+
     def has_taint(self):
-        return any(True for i in self._taint if i >= 0)
+        return self._tmap.has_taint()
 
     def in_(self, s):
         # c in '0123456789'
@@ -161,8 +2055,8 @@ class tstr(str):
         #   which is 5 - 10 + 10
         # and requesting 11 should return 6
         #   which is 5 - 10 + 11
-        if self._taint:
-            return self._taint[i]
+        if self._tmap:
+            return self._tmap[i]
         else:
             if i != 0: raise TaintException('Invalid request idx')
             # self._tcursor gets created only for empty strings.
@@ -181,10 +2075,7 @@ class tstr(str):
         >>> my_str.get_first_mapped_char()
         4
         """
-        for i in self._taint:
-            if i >= 0:
-                return i
-        return -1
+        return self._tmap.first_tainted()
 
     # tpos is the index in the input string that we are
     # looking to see if contained in this string.
@@ -196,7 +2087,18 @@ class tstr(str):
         >>> my_str.is_tpos_contained(4)
         True
         """
-        return tpos in self._taint
+        return self._tmap.contains(tpos)
+
+    # the index in the current string of the input character tpos, or -1.
+    def get_idx_of_tpos(self, tpos):
+        """
+        >>> my_str = tstr('abcdefghijkl', taint=list(range(4,16)))
+        >>> my_str.get_idx_of_tpos(6)
+        2
+        >>> my_str.get_idx_of_tpos(2)
+        -1
+        """
+        return self._tmap.index_of(tpos)
 
     # idx is the string index of current string.
     def is_idx_tainted(self, idx):
@@ -207,7 +2109,7 @@ class tstr(str):
         >>> my_str.is_idx_tainted(11)
         False
         """
-        return self._taint[idx] != -1
+        return self._tmap[idx] != -1
 
 
     def __getitem__(self, key):          # splicing ( [ ] )
@@ -233,9 +2135,9 @@ class tstr(str):
         res = super().__getitem__(key)
         if type(key) == slice:
             if res:
-                return tstr(res, self._taint[key], self)
+                return tstr(res, self._tmap[key], self)
             else:
-                t = tstr(res, self._taint[key], self)
+                t = tstr(res, self._tmap[key], self)
                 key_start = 0 if key.start is None else key.start
                 key_stop = len(res) if key.stop is None else key.stop
                 if not len(t):
@@ -248,7 +2150,7 @@ class tstr(str):
                         #is range end in str?
                         if key_stop < len(self):
                             # The only correct value for cursor.
-                            t._tcursor = self._taint[key_stop]
+                            t._tcursor = self._tmap[key_stop]
                         else:
                             # keystart was within the string but keystop was
                             # not in an empty string -- something is wrong
@@ -261,16 +2163,14 @@ class tstr(str):
                             t._tcursor = self.x()
                         else:
                             if key_start == len(self):
-                                t._tcursor = self._taint[len(self)-1] + 1 #
+                                t._tcursor = self._tmap[len(self)-1] + 1 #
                             else:
                                 # consider if we want to untaint instead
                                 raise TaintException('Can not guess taint')
                 return t
 
         elif type(key) == int:
-            if key < 0:
-                key = len(self) + key
-            return tstr(res, [self._taint[key]], self)
+            return self._char(res, self._tmap[key])
         else:
             assert False
 
@@ -331,7 +2231,7 @@ class tstr(str):
         splitted = super().split(sep, maxsplit)
         if not sep: return self._split_space(splitted)
 
-        Comparisons.append(Instr(Op.IN, self, sep))
+        _record(Op.IN, self, sep)
 
         result_list = []
         last_idx = 0
@@ -347,7 +2247,7 @@ class tstr(str):
         return result_list
 
     def _split_space(self, splitted):
-        Comparisons.append(Instr(Op.IN, self, " "))
+        _record(Op.IN, self, " ")
         result_list = []
         last_idx = 0
         first_idx = 0
@@ -379,9 +2279,9 @@ class tstr(str):
         0
         """
         if type(other) is tstr:
-            return tstr(str.__add__(self, other), (self._taint + other._taint), self)
+            return tstr(str.__add__(self, other), self._tmap.concat(other._tmap), self)
         else:
-            return tstr(str.__add__(self, other), (self._taint + [-1 for i in other]), self)
+            return tstr(str.__add__(self, other), self._tmap.concat(RunTaint.constant(len(other))), self)
 
     def __radd__(self, other):  #concatenation (+) -- other is not tstr
         """
@@ -394,9 +2294,22 @@ class tstr(str):
         0
         """
         if type(other) is tstr:
-            return tstr(str.__add__(other, self), (other._taint + self._taint), self)
+            return tstr(str.__add__(other, self), other._tmap.concat(self._tmap), self)
         else:
-            return tstr(str.__add__(other, self), ([-1 for i in other] + self._taint), self)
+            return tstr(str.__add__(other, self), RunTaint.constant(len(other)).concat(self._tmap), self)
+
+    def __mul__(self, n):  #repeating (*)
+        """
+        >>> v = tstr('ab', taint=[4, 5]) * 3
+        >>> v, v._taint
+        ('ababab', [4, 5, 4, 5, 4, 5])
+        >>> (2 * tstr('ab'))._taint, (tstr('ab') * 0)._taint
+        ([0, 1, 0, 1], [])
+        """
+        res = str.__mul__(self, n)
+        return tstr(res, concat_maps([self._tmap] * (len(res) // len(self) if res else 0)), self)
+
+    __rmul__ = __mul__
 
     def format(self, *args, **kwargs): #formatting (%) self is format string
         assert False
@@ -464,6 +2377,21 @@ class tstr(str):
         res = super().rstrip(cl)
         return self[0:len(res)]
 
+    def removeprefix(self, prefix):
+        """
+        >>> my_str = tstr('ab.cd')
+        >>> my_str.removeprefix('ab.')._taint, my_str.removesuffix('.cd')._taint
+        ([3, 4], [0, 1])
+        """
+        if prefix and self.startswith(prefix):
+            return self[len(prefix):]
+        return self
+
+    def removesuffix(self, suffix):
+        if suffix and self.endswith(suffix):
+            return self[:-len(suffix)]
+        return self
+
     def swapcase(self):
         """
         >>> my_str1 = tstr("abc")
@@ -474,7 +2402,7 @@ class tstr(str):
         2
         """
         res = super().swapcase()
-        return tstr(res, self._taint, self)
+        return tstr(res, self._case_taint(res), self)
 
     def upper(self):
         """
@@ -486,7 +2414,7 @@ class tstr(str):
         2
         """
         res = super().upper()
-        return tstr(res, self._taint, self)
+        return tstr(res, self._case_taint(res), self)
 
     def lower(self):
         """
@@ -498,7 +2426,7 @@ class tstr(str):
         2
         """
         res = super().lower()
-        return tstr(res, self._taint, self)
+        return tstr(res, self._case_taint(res), self)
 
     def capitalize(self):
         """
@@ -510,7 +2438,7 @@ class tstr(str):
         2
         """
         res = super().capitalize()
-        return tstr(res, self._taint, self)
+        return tstr(res, self._case_taint(res), self)
 
     def title(self):
         """
@@ -522,11 +2450,115 @@ class tstr(str):
         2
         """
         res = super().title()
-        return tstr(res, self._taint, self)
+        return tstr(res, self._case_taint(res), self)
+
+    def casefold(self):
+        """
+        >>> my_str1 = tstr("aBc")
+        >>> v = my_str1.casefold()
+        >>> v[1].x()
+        1
+        """
+        res = super().casefold()
+        return tstr(res, self._case_taint(res), self)
+
+    def _case_taint(self, res):
+        """
+        The taint map of a case mapping of this string. Mappings that keep
+        the length share this string's (immutable) map, so untainting
+        either string later does not touch the other.
+        >>> my_str = tstr('abc')
+        >>> v = my_str.upper()
+        >>> v._tmap is my_str._tmap
+        True
+        >>> v.untaint().has_taint(), my_str.has_taint()
+        (False, True)
+        >>> tstr('aßb').upper()._taint
+        [0, 1, 1, 2]
+        """
+        if len(res) == len(self):
+            return self._tmap
+        # some characters map to several (e.g. 'ß' to 'SS'), and each of
+        # them keeps the taint of the character it came from.
+        taint = []
+        pos = 0
+        for c, t in zip(str(self), self._tmap):
+            l = max([len(m) for m in (c.lower(), c.upper(), c.title(), c.casefold())
+                if res.startswith(m, pos)] or [1])
+            taint.extend([t] * l)
+            pos += l
+        return taint
+
+    def translate(self, table):
+        """
+        Each character of the result has the taint of the character it
+        was translated from; deleted characters leave nothing behind.
+        >>> my_str = tstr('a-b-c')
+        >>> v = my_str.translate({ord('-'): None, ord('b'): 'BB'})
+        >>> v, v._taint
+        ('aBBc', [0, 2, 2, 4])
+        """
+        res = super().translate(table)
+        taint = []
+        width = {}
+        for c, t in zip(str.__str__(self), self._tmap):
+            l = width.get(c)
+            if l is None:
+                l = width[c] = len(str.translate(c, table))
+            taint.extend([t] * l)
+        return tstr(res, taint, self)
 
     def __iter__(self):
+        """
+        >>> my_str = tstr('abc', taint=[4, 5, 6])
+        >>> [c.x() for c in my_str]
+        [4, 5, 6]
+        >>> list(my_str.iter_with_taint())
+        [('a', 4), ('b', 5), ('c', 6)]
+        """
         return tstr_iterator(self)
 
+    def iter_with_taint(self):
+        # (char, taint) pairs, without building a tstr for each character
+        return zip(str.__str__(self), self._tmap)
+
+    def _char(self, c, t):
+        """
+        A one character tstr with taint t derived from this string. When
+        no provenance is kept, these are shared per (char, taint), and
+        their taint can not be changed in place, since that would change
+        it for every holder.
+        >>> my_str = tstr('abab', taint=[0, 1, 0, 1])
+        >>> with taint_session(provenance='none'):
+        ...     my_str[0] is my_str[2], my_str[0] is my_str[1]
+        (True, False)
+        >>> with taint_session(provenance='none'):
+        ...     my_str[0].untaint()
+        Traceback (most recent call last):
+        ...
+        taintedstr.TaintException: a shared one character tstr can not be changed; change a copy (c[:]) instead
+        >>> with taint_session(provenance='none'):
+        ...     my_str[0][:].untaint().has_taint(), my_str[2].has_taint()
+        (False, True)
+        """
+        mode = _provenance_mode()
+        shared = mode == 'none'
+        if shared:
+            hit = _chars.get((c, t))
+            if hit is not None:
+                return hit
+        v = str.__new__(tstr, c)
+        v._tmap = RunTaint([1], [t], [0])
+        if shared:
+            v._parent = None
+            v._shared = True
+            if len(_chars) >= CHAR_CACHE_SIZE:
+                _chars.clear()
+            _chars[(c, t)] = v
+        else:
+            v._parent = weakref.ref(self) if mode == 'weak' else self
+        return v
+
     def expandtabs(self, n=8):
         """
         >>> my_str = tstr("ab\\tcd")
@@ -536,56 +2568,149 @@ class tstr(str):
         ['ab', 'cd']
         >>> v = my_str.expandtabs(4)
         >>> v._taint
-        [0, 1, 1, 1, 3, 4]
+        [0, 1, 2, 2, 3, 4]
+        >>> tstr('a\\tb\\n\\tc').expandtabs(3)._taint
+        [0, 1, 1, 2, 3, 4, 4, 4, 5]
+
+        Looking for the tabs is recorded, as splitting on them was.
+        >>> with recording(ListSink()) as log:
+        ...     _ = my_str.expandtabs()
+        >>> log.log
+        [?,'ab\\tcd','\\t']
         """
-        parts = self.split('\t')
+        _record(Op.IN, self, '\t')
         res = super().expandtabs(n)
-        all_parts = []
-        for i,p in enumerate(parts):
-            all_parts.extend(p._taint)
-            if i < len(parts)-1:
-                l = len(all_parts) % n
-                all_parts.extend([p._taint[-1]]*l)
-        return tstr(res, all_parts, self)
+        # the spaces of a tab keep its taint; the column starts over
+        # after each line break
+        maps = []
+        pos = col = 0
+        for m in _TAB_OR_EOL.finditer(self):
+            i = m.start()
+            maps.append(self._tmap[pos:i])
+            col += i - pos
+            if str.__getitem__(self, i) == '\t':
+                w = n - col % n if n > 0 else 0
+                maps.append(RunTaint.constant(w, self._tmap[i]))
+                col += w
+            else:
+                maps.append(self._tmap[i:i + 1])
+                col = 0
+            pos = i + 1
+        maps.append(self._tmap[pos:])
+        return tstr(res, concat_maps(maps), self)
+
+    def encode(self, encoding='utf-8', errors='strict'):
+        """
+        >>> v = tstr('aé€').encode()
+        >>> v, v._taint
+        (b'a\\xc3\\xa9\\xe2\\x82\\xac', [0, 1, 1, 2, 2, 2])
+        >>> tstr('ab').encode('utf-16-le')._taint
+        [0, 0, 1, 1]
+        """
+        res = super().encode(encoding, errors)
+        enc = codecs.lookup(encoding).name
+        if _one_byte(enc, res, self):
+            return tbytes(res, self._tmap, self)
+        if enc == 'utf-8' and errors == 'strict':
+            return tbytes(res, _utf8_taint(str.__str__(self), self._tmap, True), self)
+        # any other codec: encode one character at a time
+        e = codecs.getincrementalencoder(encoding)(errors)
+        taint = []
+        for c, t in zip(str.__str__(self), self._tmap):
+            taint.extend([t] * len(e.encode(c)))
+        taint.extend([-1] * len(e.encode('', True)))
+        return tbytes(res, taint, self)
 
     def partition(self, sep):
         partA, sep, partB = super().partition(sep)
-        return (tstr(partA, self._taint[0:len(partA)], self), tstr(sep, self._taint[len(partA): len(partA) + len(sep)], self), tstr(partB, self._taint[len(partA) + len(sep):], self))
+        return (tstr(partA, self._tmap[0:len(partA)], self), tstr(sep, self._tmap[len(partA): len(partA) + len(sep)], self), tstr(partB, self._tmap[len(partA) + len(sep):], self))
 
     def rpartition(self, sep):
         partA, sep, partB = super().rpartition(sep)
-        return (tstr(partA, self._taint[0:len(partA)], self), tstr(sep, self._taint[len(partA): len(partA) + len(sep)], self), tstr(partB, self._taint[len(partA) + len(sep):], self))
+        return (tstr(partA, self._tmap[0:len(partA)], self), tstr(sep, self._tmap[len(partA): len(partA) + len(sep)], self), tstr(partB, self._tmap[len(partA) + len(sep):], self))
+
+    def splitlines(self, keepends=False):
+        """
+        >>> my_str = tstr('ab\\r\\ncd\\n')
+        >>> [(l, l._taint) for l in my_str.splitlines()]
+        [('ab', [0, 1]), ('cd', [4, 5])]
+        >>> my_str.splitlines(True)[0]._taint
+        [0, 1, 2, 3]
+        """
+        lines = []
+        pos = 0
+        for line in super().splitlines(True):
+            l = len(line) if keepends else len(str.splitlines(line)[0])
+            lines.append(self[pos:pos + l])
+            pos += len(line)
+        return lines
 
     def ljust(self, width, fillchar=' '):
+        """
+        >>> tstr('ab').ljust(4)._taint, tstr('ab').rjust(4, tstr('*', taint=[9]))._taint
+        ([0, 1, -1, -1], [9, 9, 0, 1])
+        """
         res = super().ljust(width, fillchar)
-        initial = len(res) - len(self)
+        final = len(res) - len(self)
         if type(fillchar) is tstr:
-            t = fillchar.x()
+            t = fillchar._x()
         else:
             t = -1
-        return tstr(res, [t] * initial + self._taint, self)
+        return tstr(res, self._tmap.concat(RunTaint.constant(final, t)), self)
 
     def rjust(self, width, fillchar=' '):
         res = super().rjust(width, fillchar)
-        final = len(res) - len(self)
+        initial = len(res) - len(self)
         if type(fillchar) is tstr:
-            t = fillchar.x()
+            t = fillchar._x()
         else:
             t = -1
-        return tstr(res, self._taint + [t] * final, self)
+        return tstr(res, RunTaint.constant(initial, t).concat(self._tmap), self)
+
+    def center(self, width, fillchar=' '):
+        """
+        >>> tstr('ab').center(5, tstr('*', taint=[9]))._taint
+        [9, 9, 0, 1, 9]
+        >>> fill = tstr('*').untaint()
+        >>> tstr('ab').center(5, fill)._taint, tstr('ab').ljust(1, fill)._taint
+        ([-1, -1, 0, 1, -1], [0, 1])
+        """
+        res = super().center(width, fillchar)
+        marg = len(res) - len(self)
+        # the extra fill character goes on the right, unless the margin and
+        # the width are both odd
+        left = marg // 2 + (marg & width & 1)
+        t = fillchar._x() if type(fillchar) is tstr else -1
+        return tstr(res, concat_maps([RunTaint.constant(left, t), self._tmap,
+            RunTaint.constant(marg - left, t)]), self)
+
+    def zfill(self, width):
+        """
+        >>> tstr('-12').zfill(5)._taint
+        [0, -1, -1, 1, 2]
+        """
+        res = super().zfill(width)
+        pad = RunTaint.constant(len(res) - len(self))
+        if len(self) and str.__getitem__(self, 0) in '+-' and pad:
+            # the sign stays in front of the zeros
+            return tstr(res, concat_maps([self._tmap[:1], pad, self._tmap[1:]]), self)
+        return tstr(res, pad.concat(self._tmap), self)
 
     def join(self, iterable):
-        mystr = ''
-        mytaint = []
-        sep_taint = self._taint 
-        lst = list(iterable)
-        for i,s in enumerate(lst):
-            staint = s._taint if type(i) is tstr else [-1] * len(s)
-            mytaint.extend(staint)
-            if i <= len(lst):
-                mytaint.extend(sep_taint)
-        res = super().join(iterable)
-        return tstr(res, mytaint, self)
+        """
+        >>> my_str = tstr('ab,cd', taint=[4, 5, 6, 7, 8])
+        >>> v = tstr('-', taint=[0]).join(my_str.split(','))
+        >>> v, v._taint
+        ('ab-cd', [4, 5, 0, 7, 8])
+        >>> tstr('').join(c for c in ['x', my_str[1]])._taint
+        [-1, 5]
+        """
+        b = TaintedStringBuilder()
+        for i, s in enumerate(iterable):
+            if i:
+                b.write(self)
+            b.write(s)
+        return b.getvalue(self)
 
 
     def __format__(self, formatspec):
@@ -594,34 +2719,55 @@ class tstr(str):
         return res
 
     def __eq__(self, other):
-        global Comparisons
+        """
+        >>> my_str = tstr('a' * 5000)
+        >>> s = RecordStore()
+        >>> with recording(s):
+        ...     my_str == 'a' * 4999 + 'b'
+        False
+        >>> len(s), s[4999]
+        (5000, eq,'a','b')
+        >>> with recording(s):
+        ...     my_str[:2] == 'aaa'
+        False
+        >>> s[-1].opA._tcursor
+        2
+        """
         if len(self) == 0 and len(other) == 0:
-            Comparisons.append(Instr(Op.EQ, self, other))
+            _record(Op.EQ, self, other)
             return True
         elif len(self) == 0:
-            Comparisons.append(Instr(Op.EQ, self, other[0]))
+            _record(Op.EQ, self, other[0])
             return False
         elif len(other) == 0:
-            Comparisons.append(Instr(Op.EQ, self[0], other))
+            _record(Op.EQ, self[0], other)
             return False
-        elif len(self) == 1 and len(other) == 1:
-            Comparisons.append(Instr(Op.EQ, self, other))
-            return super().__eq__(other)
-        else:
-            if not self[0] == other[0]: return False
-            return self[1:] == other[1:]
+        # compare character by character up to the first mismatch, and
+        # record the EOF comparison if one of the strings runs out first.
+        n, m = len(self), len(other)
+        k = min(n, m)
+        i = _mismatch(str.__str__(self), str(other), k)
+        if i < k:
+            _record_chars(Op.EQ, self, other, 0, i + 1)
+            return False
+        _record_chars(Op.EQ, self, other, 0, k)
+        if n < m:
+            _record(Op.EQ, self[n:], other[n])
+        elif n > m:
+            _record(Op.EQ, self[m], other[m:])
+        return n == m
 
     def __ne__(self, other):
-        if len(self._taint) == 1 and len(other) == 1:
-            global Comparisons
-            Comparisons.append(Instr(Op.NE, self, other))
+        if len(self) == 1 and len(other) == 1:
+            _record(Op.NE, self, other)
             return super().__ne__(other)
         else:
             return not self.__eq__(other)
 
+    __hash__ = str.__hash__
+
     def __contains__(self, other):
-        global Comparisons
-        Comparisons.append(Instr(Op.IN, self, other))
+        _record(Op.IN, self, other)
         return super().__contains__(other)
 
     def replace(self, a, b, n=None):
@@ -632,21 +2778,32 @@ class tstr(str):
         'bb cde bb'
         >>> res._taint
         [-1, -1, 2, 3, 4, 5, 6, -1, -1]
+        >>> res = tstr("xax").replace('a', 'ba')
+        >>> res, res._taint
+        ('xbax', [0, -1, -1, 2])
+        >>> tstr("aaa").replace('a', 'b', 2)._taint
+        [-1, -1, 2]
         """
-        old_taint = self._taint
-        b_taint = b._taint if type(b) is tstr else [-1] * len(b)
-        mystr = str(self)
-        i = 0
-        while True:
-            if n and i >= n: break
-            idx = mystr.find(a)
-            if idx == -1: break
-            last = idx + len(a)
-            mystr = mystr.replace(a, b, 1)
-            partA, partB = old_taint[0:idx], old_taint[last:]
-            old_taint = partA + b_taint + partB
-            i += 1
-        return tstr(mystr, old_taint, self)
+        if n is None or n < 0:
+            n = -1
+        mystr = str.__str__(self)
+        res = mystr.replace(a, b, n)
+        b_map = b._tmap if type(b) is tstr else RunTaint.constant(len(b))
+        # the text between the matches, found in a single pass
+        if a:
+            pieces = [len(p) for p in mystr.split(a, n)]
+        else:
+            k = len(mystr) + 1 if n < 0 else min(n, len(mystr) + 1)
+            pieces = [0] + [1] * (k - 1) + [len(mystr) - k + 1] if k else [len(mystr)]
+        maps = []
+        pos = 0
+        for i, l in enumerate(pieces):
+            if i:
+                maps.append(b_map)
+                pos += len(a)
+            maps.append(self._tmap[pos:pos + l])
+            pos += l
+        return tstr(res, concat_maps(maps), self)
 
     def count(self, sub, start=0, end=None):
         return super().count(start, end)
@@ -659,12 +2816,11 @@ class tstr(str):
 
     # returns int
     def find(self, sub, start=None, end=None):
-        global Comparisons
         if start == None:
             start_val = 0
         if end == None:
             end_val = len(self)
-        Comparisons.append(Instr(Op.IN, self[start_val:end_val], sub))
+        _record(Op.IN, self[start_val:end_val], sub)
         return super().find(sub, start, end)
 
     # returns int
@@ -692,44 +2848,248 @@ class tstr(str):
     def isprintable(self): return super().isprintable()
 
 
-# import pudb; brk = pudb.set_trace
-def make_str_wrapper(fun):
-    def proxy(*args, **kwargs):
-        res = fun(*args, **kwargs)
-        if res.__class__ == str:
-            # brk()
-            if fun.__name__ == '__mul__': #repeating (*)
-                return tstr(res, idx=0)
-            elif fun.__name__ == '__rmul__': #repeating (*)
-                return tstr(res, idx=0)
-            elif fun.__name__ == 'splitlines':
-                return tstr(res, idx=0)
-            elif fun.__name__ == 'center':
-                return tstr(res, idx=0)
-            elif fun.__name__ == 'zfill':
-                return tstr(res, idx=0)
-            elif fun.__name__ == 'decode':
-                return tstr(res, idx=0)
-            elif fun.__name__ == 'encode':
-                return tstr(res, idx=0)
+_TAB_OR_EOL = re.compile('[\t\n\r]')
+
+class TaintedStringBuilder:
+    """
+    Collects str and tstr pieces, like io.StringIO, and builds a single
+    tstr with their taint at the end. Appending costs O(1), where
+    accumulating with + copies the taint each time.
+    >>> my_str = tstr('abc')
+    >>> b = TaintedStringBuilder()
+    >>> for c in my_str:
+    ...     _ = b.write(c)
+    ...     _ = b.write(':')
+    >>> v = b.getvalue()
+    >>> v, v._taint
+    ('a:b:c:', [0, -1, 1, -1, 2, -1])
+    """
+    def __init__(self, initial=''):
+        self._parts = []
+        # taint maps, or the length of a stretch of untainted text
+        self._maps = []
+        self._len = 0
+        if initial:
+            self.write(initial)
+
+    def write(self, s):
+        if type(s) is tstr:
+            self._parts.append(str.__str__(s))
+            self._maps.append(s._tmap)
+        elif isinstance(s, str):
+            self._parts.append(s)
+            if self._maps and type(self._maps[-1]) is int:
+                self._maps[-1] += len(s)
+            else:
+                self._maps.append(len(s))
+        else:
+            raise TypeError('expected str instance, %s found' % type(s).__name__)
+        self._len += len(s)
+        return len(s)
+
+    def __len__(self):
+        return self._len
+
+    def getvalue(self, parent=None):
+        maps = [RunTaint.constant(m) if type(m) is int else m for m in self._maps]
+        return tstr(''.join(self._parts), concat_maps(maps), parent)
+
+def _one_byte(enc, b, s):
+    # whether each character of s is the one byte at the same index of b
+    if enc == 'utf-8':
+        return bytes.isascii(b)
+    return enc in ('ascii', 'iso8859-1') and len(b) == len(s)
+_NON_ASCII = re.compile('[^\x00-\x7f]+')
+# maps each utf-8 byte to 1 if it starts a character, 0 if it continues one
+_UTF8_STARTS = bytes.maketrans(bytes(range(256)),
+        bytes(0 if 0x80 <= i < 0xc0 else 1 for i in range(256)))
+# non-ascii stretches shorter than this are mapped as lists, which keeps
+# the runs of the text around them
+_UTF8_ARRAY_MIN = 16
+
+def _utf8_taint(s, tmap, encode):
+    """
+    Maps taint between a str s and its utf-8 bytes. With encode, tmap is
+    the taint of s, and each byte gets the taint of its character.
+    Otherwise tmap is the taint of the bytes, and each character gets
+    the taint of its first byte. Ascii stretches are sliced as a whole.
+    For the others, a mask of the bytes that start a character (made
+    with bytes.translate) selects the taint in bulk: itertools.compress
+    and accumulate, or numpy above NUMPY_THRESHOLD.
+    >>> _utf8_taint('aé€', RunTaint.identity(3), True).tolist()
+    [0, 1, 1, 2, 2, 2]
+    >>> _utf8_taint('aé€', RunTaint.identity(6), False).tolist()
+    [0, 1, 3]
+    """
+    maps = []
+    i = pos = 0
+    for m in _NON_ASCII.finditer(s):
+        n = m.start() - i
+        maps.append(tmap[i:m.start()] if encode else tmap[pos:pos + n])
+        pos += n
+        starts = m.group().encode('utf-8', 'surrogatepass').translate(_UTF8_STARTS)
+        nbytes = len(starts)
+        if encode:
+            src = tmap[m.start():m.end()].toarray()
+        else:
+            src = tmap[pos:pos + nbytes].toarray()
+        piece = array.array(src.typecode)
+        if _use_numpy(nbytes):
+            mask = numpy.frombuffer(starts, dtype=numpy.uint8)
+            if encode:
+                sel = numpy.asarray(src)[numpy.cumsum(mask) - 1]
             else:
-                raise TaintException('%s Not implemented in TSTR' % fun.__name__)
+                sel = numpy.asarray(src)[mask.astype(bool)]
+            piece.frombytes(sel.tobytes())
+        elif encode:
+            # the index of the character each byte belongs to
+            owner = itertools.islice(itertools.accumulate(starts, initial=-1), 1, None)
+            piece.extend(map(src.__getitem__, owner))
+        else:
+            piece.extend(itertools.compress(src, starts))
+        if len(piece) < _UTF8_ARRAY_MIN:
+            maps.append(taint_map(piece.tolist()))
+        else:
+            maps.append(ArrayTaint(piece))
+        pos += nbytes
+        i = m.end()
+    maps.append(tmap[i:] if encode else tmap[pos:])
+    return concat_maps(maps)
+
+class tbytes(bytes):
+    """
+    bytes that carry a taint map, like tstr. Slices share the taint of
+    the parent (the bytes themselves are copied, as for bytes; use a
+    memoryview with t._tmap[a:b] for a zero copy window). Other bytes
+    methods return plain bytes.
+    >>> v = tstr('xaé!')[1:].encode('utf-8')
+    >>> v._taint
+    [1, 2, 2, 3]
+    >>> s = v[1:].decode('utf-8')
+    >>> s, s._taint
+    ('é!', [2, 3])
+    >>> (v + b'?')._taint
+    [1, 2, 2, 3, -1]
+
+    A tbytes can not be weakly referenced, so with 'weak' provenance the
+    strings derived from one have no parent.
+    >>> with taint_session(provenance='weak'):
+    ...     w = v[1:]
+    ...     w.parent, w.decode('utf-8').parent
+    (None, None)
+    """
+    def __new__(cls, value, *args, **kw):
+        return super(tbytes, cls).__new__(cls, value)
+
+    def __init__(self, value, taint=None, parent=None):
+        self.parent = parent
+        if taint:
+            assert len(taint) == len(self)
+            self._tmap = taint_map(taint)
+        else:
+            self._tmap = RunTaint.identity(len(self))
+
+    def __reduce__(self):
+        return (_restore, (tbytes, bytes(self), self._tmap))
+
+    parent = tstr.parent
+    _taint = tstr._taint
+    untaint = tstr.untaint
+    _shared = False
+    _unshared = tstr._unshared
+    has_taint = tstr.has_taint
+    x = tstr.x
+    _x = tstr._x
+    get_mapped_char_idx = tstr.get_mapped_char_idx
+    get_first_mapped_char = tstr.get_first_mapped_char
+    is_tpos_contained = tstr.is_tpos_contained
+    get_idx_of_tpos = tstr.get_idx_of_tpos
+    is_idx_tainted = tstr.is_idx_tainted
+
+    def __repr__(self):
+        return bytes.__repr__(self)
+
+    def __getitem__(self, key):
+        res = super().__getitem__(key)
+        if type(key) is slice:
+            return tbytes(res, self._tmap[key], self)
         return res
-    return proxy
-
-for name, fn in inspect.getmembers(str, callable):
-    if name not in ['__class__', '__new__', '__str__', '__init__', '__repr__',
-            '__getattribute__', '__getitem__', '__rmod__', '__mod__', '__add__',
-            '__radd__', 'strip', 'lstrip', 'rstrip', '__iter__', 'expandtabs',
-            '__format__', 'split', 'rsplit', 'format', 'join',
-            '__eq__', '__ne__', '__contains__', 'count',
-            'startswith', 'endswith', 'find', 'index', 'rfind' 'rindex',
-            'capitalize', 'replace', 'title', 'lower', 'upper', 'swapcase',
-            'partition', 'rpartition', 'ljust', 'rjust',
-            'isalnum', 'isalpha', 'isdigit', 'islower', 'isupper', 'isspace',
-            'istitle', 'isdecimal', 'isidentifier', 'isnumeric', 'isprintable'
-            ]:
-        setattr(tstr, name, make_str_wrapper(fn))
+
+    def __add__(self, other):
+        if type(other) is tbytes:
+            return tbytes(bytes.__add__(self, other), self._tmap.concat(other._tmap), self)
+        res = bytes.__add__(self, other)
+        return tbytes(res, self._tmap.concat(RunTaint.constant(len(res) - len(self))), self)
+
+    def __radd__(self, other):
+        res = bytes(other) + bytes(self)
+        return tbytes(res, RunTaint.constant(len(res) - len(self)).concat(self._tmap), self)
+
+    def decode(self, encoding='utf-8', errors='strict'):
+        """
+        >>> tbytes(b'a\\xc3\\xa9b', [4, 5, 6, 7]).decode()._taint
+        [4, 5, 7]
+        >>> tbytes('ab'.encode('utf-16-le')).decode('utf-16-le')._taint
+        [0, 2]
+        """
+        res = super().decode(encoding, errors)
+        enc = codecs.lookup(encoding).name
+        if _one_byte(enc, self, res):
+            return tstr(res, self._tmap, self)
+        if enc == 'utf-8' and errors == 'strict':
+            return tstr(res, _utf8_taint(res, self._tmap, False), self)
+        # any other codec: feed the bytes one at a time
+        d = codecs.getincrementaldecoder(encoding)(errors)
+        taint = []
+        start = 0
+        for i in range(len(self)):
+            out = d.decode(bytes.__getitem__(self, slice(i, i + 1)))
+            if out:
+                taint.extend([self._tmap[start]] * len(out))
+                start = i + 1
+        out = d.decode(b'', True)
+        taint.extend([self._tmap[start] if start < len(self) else -1] * len(out))
+        return tstr(res, taint, self)
+
+class InputTemplate:
+    """
+    Makes input tstrs whose taint maps are built once per length and
+    shared, instead of once per input. The map is the identity from
+    offset unless one is given, in which case all inputs must have its
+    length.
+    >>> tpl = InputTemplate()
+    >>> a, b = tpl('abc'), tpl('xyz')
+    >>> b._taint, a._tmap is b._tmap
+    ([0, 1, 2], True)
+    >>> InputTemplate(taint=[5, 9])('ab')._taint
+    [5, 9]
+    >>> tpl('')[0:]._tcursor
+    0
+    """
+    def __init__(self, offset=0, taint=None):
+        self.offset = offset
+        self._map = None if taint is None else taint_map(taint)
+        self._maps = {}
+
+    def __call__(self, value):
+        n = len(value)
+        m = self._map
+        if m is None:
+            m = self._maps.get(n)
+            if m is None:
+                m = self._maps[n] = RunTaint.identity(n, self.offset)
+        elif len(m) != n:
+            raise ValueError('the template is for inputs of length %d' % len(m))
+        return _restore(tstr, value, m, None if n else self.offset)
+
+def _restore(cls, value, tmap, cursor=None):
+    # rebuilds a pickled tstr or tbytes, without a parent
+    v = cls.__new__(cls, value)
+    v._parent = None
+    v._tmap = tmap
+    if cursor is not None:
+        v._tcursor = cursor
+    return v
 
 def get_t(v):
     if type(v) is tstr: return v